@@ -1,25 +1,29 @@
+import argparse
 import itertools
 import logging
-import socket
+import os
 import sys
-from datetime import datetime, timezone
+from datetime import datetime
 # OrderedDict doesn't show in IntelliJ for some reason.
 # noinspection PyUnresolvedReferences
-from typing import DefaultDict, Iterable, List, OrderedDict, Set, Tuple, Union
-
-from ruamel.yaml import YAML
-from ruamel.yaml.comments import CommentedMap  # Hack: prevents !!omap annotation in YAML output
-
-from fedimap.access_log import parse_log_file, LogRecord
-from fedimap.evidence import TimeWindowAcc, UserAgentEvidence, ReverseDNSEvidence,\
-    ForwardDNSEvidence, TLSCertCheckEvidence, InstanceAPIEvidence, IPEvidence,\
-    InstanceEvidence
-from fedimap.instance_api import UNKNOWN_SERVER_TYPE, get_instance_info
+from typing import DefaultDict, Iterable, List, Optional, OrderedDict, Set, Union
+
+from fedimap.access_log import cache_stats, LogRecord
+from fedimap.discovery import forward_dns, reverse_dns, tls_evidence, probe
+from fedimap.evidence import ActiveDaysAcc, ActiveDaysFrozen, TimeWindowAcc, UserAgentEvidence,\
+    ReverseDNSEvidence, ForwardDNSEvidence, TLSCertCheckEvidence, InstanceAPIEvidence, IPEvidence,\
+    InstanceEvidence, Evidence, TrafficAcc, TrafficFrozen
+from fedimap.incoming import IncomingIPsAcc, aggregate_log_records
+from fedimap.log_format import AUTO, LOG_FORMATS, parse_log_file
 from fedimap.net import fmt_ip, extract_hostname_and_port, get_domain
-from fedimap.user_agent import classify_user_agent, InstanceUserAgent
+from fedimap.pipeline import DEFAULT_WORKERS, DiscoveryPipeline
+from fedimap.planner import CONCLUSIVE, EXACT, PLAN_MODES, EvidencePlanner
+from fedimap.progress import Progress
+from fedimap.tls import check_tls_certs
+from fedimap.user_agent import InstanceUserAgent
 
 
-IPInfoFrozen = OrderedDict[str, Union[bool, str]]
+IPInfoFrozen = OrderedDict[str, Union[bool, str, ActiveDaysFrozen, TrafficFrozen]]
 
 
 class IPInfoAcc:
@@ -30,9 +34,14 @@ class IPInfoAcc:
     forward: bool = False
     reverse: bool = False
     time_window: TimeWindowAcc
+    # Days this IP made requests to us. Doesn't include days we looked it up in DNS.
+    active_days: ActiveDaysAcc
+    traffic: TrafficAcc
 
     def __init__(self):
         self.time_window = TimeWindowAcc()
+        self.active_days = ActiveDaysAcc()
+        self.traffic = TrafficAcc()
 
     def add(self, evidence: IPEvidence) -> TimeWindowAcc:
         """
@@ -41,6 +50,8 @@ class IPInfoAcc:
         if isinstance(evidence, UserAgentEvidence):
             self.inbound = True
             self.time_window.add(evidence.time_window)
+            self.active_days.add(evidence.time_window.days)
+            self.traffic.add(evidence.traffic)
             return evidence.time_window
         elif isinstance(evidence, ForwardDNSEvidence):
             self.forward = True
@@ -54,11 +65,15 @@ class IPInfoAcc:
             raise NotImplementedError()
 
     def freeze(self) -> IPInfoFrozen:
+        from ruamel.yaml.comments import CommentedMap
+
         od = OrderedDict()
         od['inbound'] = self.inbound
         od['forward'] = self.forward
         od['reverse'] = self.reverse
         od.update(self.time_window.freeze())
+        od['active_days'] = self.active_days.freeze()
+        od['traffic'] = CommentedMap(self.traffic.freeze())  # Hack: prevents !!omap annotation
         return CommentedMap(od)  # Hack: prevents !!omap annotation in YAML output
 
 
@@ -68,6 +83,8 @@ InstanceInfoFrozen = OrderedDict[
         bool,
         str,
         OrderedDict[str, IPInfoFrozen],
+        OrderedDict[str, ActiveDaysFrozen],
+        TrafficFrozen,
         List[str]
     ]
 ]
@@ -79,23 +96,34 @@ class InstanceInfoAcc:
     """
     # Map of IP to IP info accumulator.
     tls_cert_ok: bool = False
+    # Earliest expiry of the TLS certs checked, and the names they cover.
+    tls_cert_not_after: Optional[datetime] = None
+    tls_cert_names: Set[str]
     instance_api_called: bool = False
     urls: Set[str]
     ips: DefaultDict[bytes, IPInfoAcc]
     user_agents: DefaultDict[InstanceUserAgent, TimeWindowAcc]
     time_window: TimeWindowAcc
+    # Requests from all of this instance's IPs.
+    traffic: TrafficAcc
 
     # noinspection PyTypeHints
     def __init__(self):
+        self.tls_cert_names = set()
         self.urls = set()
         self.ips = DefaultDict(IPInfoAcc)
         self.user_agents = DefaultDict(TimeWindowAcc)
         self.time_window = TimeWindowAcc()
+        self.traffic = TrafficAcc()
 
     def add(self, evidence: Union[InstanceEvidence, IPEvidence]) -> None:
         if isinstance(evidence, TLSCertCheckEvidence):
             self.tls_cert_ok = True
             self.time_window.add(evidence.time)
+            if evidence.not_after is not None and (self.tls_cert_not_after is None
+                                                   or evidence.not_after < self.tls_cert_not_after):
+                self.tls_cert_not_after = evidence.not_after
+            self.tls_cert_names.update(evidence.subject_alt_names)
         elif isinstance(evidence, InstanceAPIEvidence):
             self.instance_api_called = True
             self.time_window.add(evidence.time)
@@ -106,21 +134,36 @@ class InstanceInfoAcc:
             self.time_window.add(time_window)
             if isinstance(evidence, UserAgentEvidence):
                 self.user_agents[evidence.instance_user_agent].add(time_window)
+                self.traffic.add(evidence.traffic)
 
     def freeze(self) -> InstanceInfoFrozen:
+        from ruamel.yaml.comments import CommentedMap
+
         od = OrderedDict()
         od['urls'] = sorted(self.urls)
         od['tls_cert_ok'] = self.tls_cert_ok
+        od['tls_cert_expires'] = self.tls_cert_not_after.strftime('%Y-%m-%d') \
+            if self.tls_cert_not_after is not None \
+            else None
+        od['tls_cert_names'] = sorted(self.tls_cert_names)
         od['instance_api_called'] = self.instance_api_called
         od.update(self.time_window.freeze())
-
-        # TODO: ignore time windows for now
-        od['versions'] = sorted(set(
-            '{server} {version}'.format(server=ua.server, version=ua.version)
-            if ua.version is not None
-            else ua.server
-            for ua in self.user_agents.keys()
-        ))
+        od['traffic'] = CommentedMap(self.traffic.freeze())  # Hack: prevents !!omap annotation
+
+        # Map of version to days it was seen on.
+        # Several user agents can have the same version, such as when an instance has several
+        # hostnames.
+        # noinspection PyTypeHints
+        version_days: DefaultDict[str, ActiveDaysAcc] = DefaultDict(ActiveDaysAcc)
+        for ua, time_window in self.user_agents.items():
+            version = '{server} {version}'.format(server=ua.server, version=ua.version) \
+                if ua.version is not None \
+                else ua.server
+            version_days[version].add(time_window.days)
+        frozen_versions = OrderedDict()
+        for version in sorted(version_days.keys()):
+            frozen_versions[version] = version_days[version].freeze()
+        od['versions'] = CommentedMap(frozen_versions)  # Hack: prevents !!omap annotation
 
         frozen_ips = OrderedDict()
         for ip in sorted(self.ips.keys()):
@@ -130,127 +173,277 @@ class InstanceInfoAcc:
         return CommentedMap(od)  # Hack: prevents !!omap annotation in YAML output
 
 
+_size_suffixes = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_size(s: str) -> int:
+    """
+    Parse a byte count with an optional binary suffix, like `512M` or `2G`.
+    """
+    s = s.strip().upper()
+    if s.endswith('B'):
+        s = s[:-1]
+    suffix = s[-1:] if s[-1:] in _size_suffixes else ''
+    try:
+        size = int(s[:len(s) - len(suffix)]) * _size_suffixes[suffix]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: {s!r}'.format(s=s))
+    if size <= 0:
+        raise argparse.ArgumentTypeError('size must be positive: {s!r}'.format(s=s))
+    return size
+
+
+def parse_positive_int(s: str) -> int:
+    """
+    Parse a count that must be at least 1, like a number of worker threads.
+    """
+    try:
+        n = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid number: {s!r}'.format(s=s))
+    if n <= 0:
+        raise argparse.ArgumentTypeError('number must be positive: {s!r}'.format(s=s))
+    return n
+
+
+def parse_port(s: str) -> int:
+    """
+    Parse a TCP port number, where 0 means any free port.
+    """
+    try:
+        port = int(s)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid port: {s!r}'.format(s=s))
+    if not 0 <= port <= 65535:
+        raise argparse.ArgumentTypeError('port must be from 0 to 65535: {s!r}'.format(s=s))
+    return port
+
+
+def parse_args(args: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='fedimap',
+        description='Build a map of which Fediverse instances use which IPs '
+                    'from web server access logs. '
+                    'Run "%(prog)s diff OLD NEW" to compare two maps instead.',
+    )
+    parser.add_argument(
+        '--log-format', choices=[AUTO] + sorted(LOG_FORMATS.keys()), default=AUTO,
+        help='access log format: Combined Log Format, or JSON lines from nginx or Caddy '
+             '(default: detect it from the first lines of each file)',
+    )
+    parser.add_argument(
+        '--batch', action='store_true',
+        help='parse logs in chunks and aggregate them with NumPy: '
+             'faster for very large logs, same output',
+    )
+    parser.add_argument(
+        '--batch-size', type=parse_positive_int, metavar='LINES',
+        help='lines from instances per chunk in batch mode (default: about a million)',
+    )
+    parser.add_argument(
+        '--max-memory', type=parse_size, metavar='SIZE',
+        help='approximate memory limit for log aggregation, like 512M or 2G: '
+             'past it, partial results are spilled to temporary files and merged at the end',
+    )
+    parser.add_argument(
+        '--tmp-dir', metavar='DIR',
+        help='where to spill partial results when --max-memory is set '
+             '(default: the system temporary directory)',
+    )
+    parser.add_argument(
+        '--distinct-paths', action='store_true',
+        help='also estimate how many distinct paths each IP and instance requested, '
+             'with a fixed-size sketch per IP and user agent (about 6.5%% error)',
+    )
+    parser.add_argument(
+        '--progress-interval', type=float, default=10.0, metavar='SECONDS',
+        help='log progress at most this often, or never if 0 (default: %(default)g)',
+    )
+    parser.add_argument(
+        '--metrics-port', type=parse_port, metavar='PORT',
+        help='serve progress metrics in Prometheus format on localhost:PORT/metrics during the run',
+    )
+    parser.add_argument(
+        '--plan', choices=PLAN_MODES, default=EXACT,
+        help='how much network work to skip: "full" does every lookup and probe, '
+             '"exact" skips work that can\'t change the output, plus probes of hostnames whose '
+             'TLS cert failed verification (logged as lossy), '
+             '"conclusive" also stops probing an instance once it\'s confirmed '
+             '(default: %(default)s)',
+    )
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help='start DNS lookups and probes while logs are still being parsed: '
+             'same output, less waiting',
+    )
+    parser.add_argument(
+        '--workers', type=parse_positive_int, default=DEFAULT_WORKERS, metavar='N',
+        help='network lookups to run at once with --pipeline, '
+             'and TLS cert checks to run at once otherwise (default: %(default)d)',
+    )
+    parser.add_argument('log_files', nargs='+', metavar='LOG_FILE', help='access log to scan')
+    options = parser.parse_args(args[1:])
+    if options.pipeline and options.plan == CONCLUSIVE:
+        parser.error('--plan conclusive needs all logs parsed first, so it can\'t be used '
+                     'with --pipeline')
+    return options
+
+
+def aggregate_logs(options: argparse.Namespace,
+                   incoming_ips: IncomingIPsAcc,
+                   progress: Progress) -> None:
+    if options.batch:
+        # Deferred: NumPy is slow to import and only needed in batch mode.
+        from fedimap.batch import DEFAULT_CHUNK_SIZE, aggregate_log_files_batch
+        chunk_size = DEFAULT_CHUNK_SIZE if options.batch_size is None else options.batch_size
+        aggregate_log_files_batch(options.log_files, incoming_ips, chunk_size=chunk_size,
+                                  on_line=progress.parsed_line, log_format=options.log_format)
+    else:
+        log_records_all_files: Iterable[LogRecord] = itertools.chain.from_iterable(
+            parse_log_file(path, log_format=options.log_format, on_line=progress.parsed_line)
+            for path in options.log_files
+        )
+        aggregate_log_records(log_records_all_files, incoming_ips)
+
+
+def discover(planner: EvidencePlanner, progress: Progress, workers: int) -> List[Evidence]:
+    """
+    Run network lookups in the order the planner gives them:
+    one at a time, except for TLS cert checks, which are cheap and run `workers` at once.
+    """
+    all_evidence: List[Evidence] = []
+
+    # Forward DNS goes first so its results can rule out reverse DNS lookups and probes.
+    forward_dns_hostnames = planner.forward_dns_hostnames()
+    progress.start_stage('forward_dns', len(forward_dns_hostnames))
+    for hostname in forward_dns_hostnames:
+        result = forward_dns(hostname)
+        all_evidence.extend(result.evidence)
+        planner.record_forward_dns(hostname, result.evidence, result.exists)
+        progress.advance('forward_dns')
+
+    reverse_dns_ips = planner.reverse_dns_ips()
+    progress.start_stage('reverse_dns', len(reverse_dns_ips))
+    for ip in reverse_dns_ips:
+        all_evidence.extend(reverse_dns(ip))
+        progress.advance('reverse_dns')
+
+    tls_checks = planner.tls_checks()
+    progress.start_stage('tls', len(tls_checks))
+    for hostname, port, result in check_tls_certs(tls_checks, workers=workers):
+        evidence = tls_evidence(hostname, port, result.info)
+        all_evidence.extend(evidence)
+        planner.record_tls(hostname, port, evidence, result.valid)
+        progress.advance('tls')
+
+    progress.start_stage('probe', planner.num_probes())
+    for hostname, port in planner.probes():
+        evidence = probe(hostname, port)
+        all_evidence.extend(evidence)
+        planner.record_probe(evidence)
+        progress.advance('probe')
+    # Skipped probes won't run, so don't leave them queued.
+    progress.stages['probe'].total = progress.stages['probe'].done
+
+    planner.report()
+    return all_evidence
+
+
 def main(args: List[str]) -> None:
+    if len(args) > 1 and args[1] == 'diff':
+        from fedimap import diff
+        diff.main(args[2:])
+        return
+
+    options = parse_args(args)
+
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger(__name__)
 
     all_evidence = []
 
-    log_records_all_files: Iterable[LogRecord] = \
-        itertools.chain.from_iterable(parse_log_file(path) for path in args[1:])
-    # noinspection PyTypeHints
-    incoming_ips: DefaultDict[bytes, DefaultDict[InstanceUserAgent, TimeWindowAcc]] = \
-        DefaultDict(lambda: DefaultDict(TimeWindowAcc))
-
-    for log_record in log_records_all_files:
-        if log_record.user_agent is None:
-            continue
-        instance_user_agent = classify_user_agent(log_record.user_agent)
-        if instance_user_agent is None:
-            continue
-        incoming_ips[log_record.ip][instance_user_agent].add(log_record.timestamp)
-
-    possible_instance_ips: Set[bytes] = set(incoming_ips.keys())
-    possible_instance_hostnames: Set[str] = set()
-    possible_instance_hostnames_and_ports: Set[Tuple[str, int]] = set()
-
-    for ip in incoming_ips.keys():
-        for instance_user_agent in incoming_ips[ip].keys():
-            time_window = incoming_ips[ip][instance_user_agent]
-
-            if instance_user_agent.url is not None:
-                hostname_and_port = extract_hostname_and_port(instance_user_agent.url)
-                if hostname_and_port is not None:
-                    hostname, port = hostname_and_port
-
-                    possible_instance_hostnames.add(hostname)
-                    possible_instance_hostnames_and_ports.add(hostname_and_port)
-
-                    all_evidence.append(UserAgentEvidence(
-                        ip=ip,
-                        hostname=hostname,
-                        domain=get_domain(hostname),
-                        port=port,
-                        instance_user_agent=instance_user_agent,
-                        time_window=time_window,
-                    ))
-
-    for ip in possible_instance_ips:
-        ip_str = fmt_ip(ip)
+    progress = Progress(
+        interval=options.progress_interval,
+        total_bytes=sum(os.path.getsize(path) for path in options.log_files),
+    )
+    metrics_server = None
+    if options.metrics_port is not None:
+        # Deferred: http.server pulls in a lot of the standard library.
+        from fedimap.metrics import MetricsServer
         try:
-            time = datetime.now(timezone.utc)
-            hostname, aliases, addresses = socket.gethostbyaddr(ip_str)
-            aliases = [alias for alias in aliases
-                       if not alias.endswith('.in-addr.arpa')
-                       and not alias.endswith('.ip6.arpa')]
-            if addresses != [ip_str]:
-                # TODO: when would this happen?
-                logger.warning('%(ip_str)s resolved to multiple IPs: %(addresses)r',
-                               {'ip_str': ip_str, 'addresses': addresses})
-
-            for alias in [hostname] + aliases:
-                all_evidence.append(ReverseDNSEvidence(
-                    ip=ip,
-                    hostname=alias,
-                    domain=get_domain(alias),
-                    time=time,
-                ))
-        except OSError:
-            logger.warning(
-                "Exception on reverse DNS lookup for %(ip_str)s!",
-                {'ip_str': ip_str},
-                exc_info=True
-            )
-
-    for hostname in possible_instance_hostnames:
-        try:
-            time = datetime.now(timezone.utc)
-            # noinspection PyArgumentList
-            for af, _, _, _, sockaddr in socket.getaddrinfo(hostname, None,
-                                                            family=socket.AF_INET,
-                                                            type=socket.SOCK_STREAM,
-                                                            proto=socket.IPPROTO_IP):
-                ip_str = sockaddr[0]
-                ip = socket.inet_pton(af, ip_str)
-                all_evidence.append(ForwardDNSEvidence(
+            metrics_server = MetricsServer(progress, options.metrics_port)
+        except OSError as e:
+            # Metrics are only for watching the run, so carry on without them.
+            logger.error("Couldn't serve metrics on port %(port)d: %(error)s",
+                         {'port': options.metrics_port, 'error': e})
+        else:
+            metrics_server.start()
+            logger.info("Serving metrics at http://127.0.0.1:%(port)d/metrics",
+                        {'port': metrics_server.port})
+
+    incoming_ips: IncomingIPsAcc
+    if options.max_memory is not None:
+        from fedimap.spill import SpillingIncomingIPsAcc
+        incoming_ips = SpillingIncomingIPsAcc.for_max_memory(options.max_memory,
+                                                             tmp_dir=options.tmp_dir,
+                                                             distinct_paths=options.distinct_paths)
+    else:
+        incoming_ips = IncomingIPsAcc(distinct_paths=options.distinct_paths)
+
+    pipeline = None
+    if options.pipeline:
+        pipeline = DiscoveryPipeline(progress, mode=options.plan, workers=options.workers)
+        incoming_ips.on_new_entry = pipeline.add_entry
+
+    try:
+        aggregate_logs(options, incoming_ips, progress)
+    except BaseException:
+        if pipeline is not None:
+            pipeline.cancel()
+        raise
+    progress.finish_parsing()
+    progress.report()
+
+    for field, stats in cache_stats().items():
+        logger.info("%(field)s cache: %(hits)d hits, %(misses)d misses, %(hit_rate).1f%% hit rate.",
+                    {'field': field, 'hits': stats.hits, 'misses': stats.misses,
+                     'hit_rate': 100 * stats.hit_rate})
+    if options.max_memory is not None:
+        logger.info("Spilled %(num_spilled)d entries to %(num_runs)d runs.",
+                    {'num_spilled': incoming_ips.num_spilled, 'num_runs': len(incoming_ips.runs)})
+
+    possible_instance_ips: Set[bytes] = set()
+    user_agent_evidence: List[UserAgentEvidence] = []
+
+    for ip, instance_user_agent, time_window, traffic in incoming_ips.items():
+        possible_instance_ips.add(ip)
+
+        if instance_user_agent.url is not None:
+            hostname_and_port = extract_hostname_and_port(instance_user_agent.url)
+            if hostname_and_port is not None:
+                hostname, port = hostname_and_port
+                user_agent_evidence.append(UserAgentEvidence(
                     ip=ip,
                     hostname=hostname,
                     domain=get_domain(hostname),
-                    time=time,
+                    port=port,
+                    instance_user_agent=instance_user_agent,
+                    time_window=time_window,
+                    traffic=traffic,
                 ))
-        except OSError:
-            logger.warning(
-                "Exception on forward DNS lookup for %(hostname)s!",
-                {'hostname': hostname},
-                exc_info=True
-            )
-
-    for hostname, port in possible_instance_hostnames_and_ports:
-        logger.info("%s:%d", hostname, port)  # DEBUG
-        time = datetime.now(timezone.utc)
-        instance_user_agent = get_instance_info(hostname, port)
-
-        if instance_user_agent is not None:
-            all_evidence.append(TLSCertCheckEvidence(
-                hostname=hostname,
-                domain=get_domain(hostname),
-                port=port,
-                time=time,
-            ))
-
-            if instance_user_agent.server != UNKNOWN_SERVER_TYPE \
-                    and instance_user_agent.url is not None:
-                reported_hostname_and_port = extract_hostname_and_port(instance_user_agent.url)
-                if reported_hostname_and_port is not None:
-                    reported_hostname, reported_port = reported_hostname_and_port
-                    if hostname == reported_hostname and port == reported_port:
-                        all_evidence.append(InstanceAPIEvidence(
-                            hostname=hostname,
-                            domain=get_domain(hostname),
-                            port=port,
-                            instance_user_agent=instance_user_agent,
-                            time=time,
-                        ))
+    incoming_ips.close()
+    all_evidence.extend(user_agent_evidence)
+
+    if pipeline is not None:
+        # Lookups have been running since parsing started.
+        all_evidence.extend(pipeline.results())
+    else:
+        planner = EvidencePlanner(possible_instance_ips, user_agent_evidence, mode=options.plan)
+        all_evidence.extend(discover(planner, progress, options.workers))
+
+    progress.report()
+    if metrics_server is not None:
+        metrics_server.stop()
 
     # TODO: Ignores ports: I've not seen a non-443 instance yet.
 
@@ -265,6 +458,9 @@ def main(args: List[str]) -> None:
         frozen[instance] = instances[instance].freeze()
 
     # Dump output as YAML.
+    from ruamel.yaml import YAML
+    from ruamel.yaml.comments import CommentedMap  # Hack: prevents !!omap annotation in YAML output
+
     yaml = YAML()
     yaml.indent(mapping=2, sequence=2, offset=1)
     yaml.dump(CommentedMap(frozen), sys.stdout)  # Hack: prevents !!omap annotation in YAML output
@@ -12,13 +12,15 @@ See https://httpd.apache.org/docs/current/mod/mod_log_config.html
 See https://nginx.org/en/docs/http/ngx_http_log_module.html
 """
 
-__all__ = ['LogRecord', 'parse_log_line', 'parse_log_file']
+__all__ = ['LogRecord', 'CacheStats', 'COMMON_DATETIME_FORMAT', 'COMBINED_RE', 'unescape_decode',
+           'parse_ip', 'parse_user_agent', 'parse_log_line', 'parse_log_file', 'cache_stats']
 
 import codecs
+import functools
 import re
 import socket
 from datetime import datetime
-from typing import NamedTuple, Optional
+from typing import Callable, Dict, Iterator, NamedTuple, Optional
 
 
 class LogRecord(NamedTuple):
@@ -34,9 +36,9 @@ class LogRecord(NamedTuple):
     user_agent: Optional[str] = None
 
 
-_common_datetime = '%d/%b/%Y:%H:%M:%S %z'
+COMMON_DATETIME_FORMAT = '%d/%b/%Y:%H:%M:%S %z'
 
-_combined_re = re.compile(
+COMBINED_RE = re.compile(
     br'''
         ^
         (?P<ip>[0-9a-fA-F.:]+)
@@ -44,7 +46,7 @@ _combined_re = re.compile(
         -
         \ # Optional. Note that usernames are not quoted but may have whitespace in them anyway.
         (?P<username>.+?)
-        \ # See _common_datetime.
+        \ # See COMMON_DATETIME_FORMAT.
         \[(?P<datetime>\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2}\ [+-]\d{4})\]
         \ # Technically this is just the first line of the request.
         "(?P<method>\w+)\ (?P<path>[^"]+)\ (?P<protocol>\w+/[\d.]+)"
@@ -62,7 +64,7 @@ _combined_re = re.compile(
 )
 
 
-def _unescape_decode(b: bytes) -> str:
+def unescape_decode(b: bytes) -> str:
     """
     Process backslash escapes in fields that can contain non-alphanumeric/non-ASCII characters,
     then decode as UTF-8.
@@ -80,31 +82,80 @@ def _dash_empty(s: str) -> Optional[str]:
     return None if s == '-' else s
 
 
+# Bounds for the caches of decoded IPs and user agents.
+# In real logs, the same few thousand of each repeat millions of times.
+_ip_cache_size = 1 << 16
+_user_agent_cache_size = 1 << 16
+
+
+@functools.lru_cache(maxsize=_ip_cache_size)
+def parse_ip(b: bytes) -> bytes:
+    """
+    Convert an IP from a log line to packed form.
+    Cached, so repeated IPs share one object.
+
+    :raises UnicodeError, OSError: if the IP can't be parsed.
+    """
+    ip_str = b.decode('ascii')
+    if ':' in ip_str:
+        return socket.inet_pton(socket.AF_INET6, ip_str)
+    else:
+        return socket.inet_pton(socket.AF_INET, ip_str)
+
+
+@functools.lru_cache(maxsize=_user_agent_cache_size)
+def parse_user_agent(b: bytes) -> Optional[str]:
+    """
+    Decode a user agent from a log line.
+    Cached, so repeated user agents share one object.
+
+    :raises UnicodeError, ValueError: if the user agent can't be decoded.
+    """
+    return _dash_empty(unescape_decode(b))
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def cache_stats() -> Dict[str, CacheStats]:
+    """
+    :return: Hit and miss counts for the IP and user agent caches, by field name.
+    """
+    return {
+        'ip': CacheStats(*parse_ip.cache_info()),
+        'user_agent': CacheStats(*parse_user_agent.cache_info()),
+    }
+
+
 def parse_log_line(line: bytes) -> Optional[LogRecord]:
     """
     Parse one log line and return a `LogRecord` if possible, `None` otherwise.
     """
-    match = _combined_re.match(line)
+    match = COMBINED_RE.match(line)
     if match is None:
         return None
     groups = match.groupdict()
 
     try:
-        ip_str = groups['ip'].decode('ascii')
-        if ':' in ip_str:
-            ip = socket.inet_pton(socket.AF_INET6, ip_str)
-        else:
-            ip = socket.inet_pton(socket.AF_INET, ip_str)
-
-        username = _dash_empty(_unescape_decode(groups['username']))
-        timestamp = datetime.strptime(groups['datetime'].decode('ascii'), _common_datetime)
+        ip = parse_ip(groups['ip'])
+        username = _dash_empty(unescape_decode(groups['username']))
+        timestamp = datetime.strptime(groups['datetime'].decode('ascii'), COMMON_DATETIME_FORMAT)
         method = groups['method'].decode('ascii')
-        path = _unescape_decode(groups['path'])
+        path = unescape_decode(groups['path'])
         protocol = groups['protocol'].decode('ascii')
         status = int(groups['status'].decode('ascii'))
         size = int(groups['size'].decode('ascii'))
-        referrer = _dash_empty(_unescape_decode(groups['referrer']))
-        user_agent = _dash_empty(_unescape_decode(groups['user_agent']))
+        referrer = _dash_empty(unescape_decode(groups['referrer']))
+        user_agent = parse_user_agent(groups['user_agent'])
 
         return LogRecord(
             ip=ip,
@@ -123,9 +174,18 @@ def parse_log_line(line: bytes) -> Optional[LogRecord]:
         return None
 
 
-def parse_log_file(path):
+def parse_log_file(path: str,
+                   on_line: Optional[Callable[[int], None]] = None,
+                   parse_line: Callable[[bytes], Optional[LogRecord]] = parse_log_line
+                   ) -> Iterator[LogRecord]:
+    """
+    :param on_line: Called with the size in bytes of every line read, for progress reporting.
+    :param parse_line: Parser for the log format, such as those in `fedimap.log_format`.
+    """
     with open(path, 'rb') as f:
         for line in f:
-            log_record = parse_log_line(line)
+            if on_line is not None:
+                on_line(len(line))
+            log_record = parse_line(line)
             if log_record is not None:
                 yield log_record
@@ -2,7 +2,7 @@ from datetime import datetime, timezone
 import socket
 import unittest
 
-from fedimap.access_log import parse_log_line, LogRecord
+from fedimap.access_log import cache_stats, parse_log_line, LogRecord
 
 
 class TestAccessLog(unittest.TestCase):
@@ -63,3 +63,16 @@ class TestAccessLog(unittest.TestCase):
         log_record = parse_log_line(br'::1 - - [27/Dec/2018:19:00:36 +0000] "GET /ipv6 HTTP/1.1" '
                                     br'404 169 "-" "-"')
         self.assertEqual(log_record.ip, socket.inet_pton(socket.AF_INET6, '::1'))
+
+    def test_repeated_fields_shared(self):
+        line = br'12.34.56.78 - - [27/Dec/2018:18:20:28 +0000] "GET /example HTTP/2.0" 200 728 ' \
+               br'"-" "curl/7.52.1"'
+        before = cache_stats()
+        first = parse_log_line(line)
+        second = parse_log_line(line)
+        after = cache_stats()
+        self.assertIs(first.ip, second.ip)
+        self.assertIs(first.user_agent, second.user_agent)
+        self.assertGreaterEqual(after['ip'].hits - before['ip'].hits, 1)
+        self.assertGreaterEqual(after['user_agent'].hits - before['user_agent'].hits, 1)
+        self.assertGreater(after['ip'].hit_rate, 0.0)
@@ -0,0 +1,490 @@
+"""
+Columnar batch ingestion for access logs.
+
+Instead of building a `LogRecord` for every line and folding it into the accumulators one at a
+time, lines are parsed in chunks into parallel columns of interned IP IDs, instance user agent IDs,
+and epoch timestamps, statuses, and sizes. Per-(IP, user agent) first and last times and traffic
+counts are then found with vectorized sorts and group boundaries, so the Python-level accumulator
+work scales with the number of distinct (IP, user agent) pairs per chunk rather than the number
+of lines.
+
+For Combined Log Format, only the IP, timestamp, and user agent fields are parsed. The username,
+path, and referrer fields are only checked to see if they decode, so lines are dropped exactly when
+`parse_log_line` would drop them. Other formats are parsed into `LogRecord`s first, then columnized.
+"""
+
+__all__ = ['DEFAULT_CHUNK_SIZE', 'aggregate_log_file_batch', 'aggregate_log_files_batch']
+
+from array import array
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+from fedimap.access_log import LogRecord, COMBINED_RE, COMMON_DATETIME_FORMAT, parse_ip, \
+    parse_user_agent, unescape_decode
+from fedimap.evidence import TRAFFIC_SLOTS, TimeWindowAcc, TrafficAcc
+from fedimap.incoming import IncomingIPsAcc
+from fedimap.sketch import HyperLogLog, hll_hash, hll_register
+from fedimap.log_format import AUTO, LOG_FORMATS, detect_log_format
+from fedimap.spill import SpillingIncomingIPsAcc
+from fedimap.user_agent import classify_user_agent, InstanceUserAgent
+
+# Lines from instances per chunk.
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# Groups folded into the accumulator at a time.
+_fold_slice_size = 4096
+
+# Caches keyed on raw field bytes are cleared when they grow past this many entries,
+# so that hostile logs with random user agents can't grow them without bound.
+_max_raw_cache_entries = 1 << 20
+
+_seconds_per_day = 24 * 60 * 60
+_epoch_ordinal = date(1970, 1, 1).toordinal()
+
+# Marks a raw user agent that isn't from an instance.
+_not_instance = -1
+
+# Register and rank for a path that couldn't be decoded. A rank of 0 never changes a register.
+_no_path_register = (0, 0)
+
+
+def _epoch_and_offset(timestamp: datetime) -> Tuple[int, int]:
+    """
+    Sub-second precision is dropped, as in Combined Log Format.
+    """
+    return int(timestamp.timestamp()), int(timestamp.utcoffset().total_seconds())
+
+
+class _Interner:
+    """
+    Maps raw field bytes to small integer IDs, shared across all chunks of a run.
+    """
+    # Raw IP field → IP ID.
+    raw_ips: Dict[bytes, int]
+    # Packed IP → IP ID. Different spellings of the same IP share an ID.
+    packed_ip_ids: Dict[bytes, int]
+    packed_ips: List[bytes]
+    # Raw user agent field → instance user agent ID, or `_not_instance`.
+    raw_user_agents: Dict[bytes, int]
+    # Instance user agent → instance user agent ID.
+    instance_user_agent_ids: Dict[InstanceUserAgent, int]
+    instance_user_agents: List[InstanceUserAgent]
+    # Raw datetime field → (seconds since epoch, UTC offset in seconds).
+    raw_datetimes: Dict[bytes, Tuple[int, int]]
+    # Raw escaped field (username, path, or referrer) → whether it decodes.
+    raw_escaped: Dict[bytes, bool]
+    # Raw or decoded path → distinct path sketch (register, rank), if counting distinct paths.
+    path_registers: Optional[Dict[Union[bytes, str], Tuple[int, int]]] = None
+
+    # Size limit for each cache and each table of IDs.
+    max_entries: int
+
+    def __init__(self, distinct_paths: bool = False, max_entries: int = _max_raw_cache_entries):
+        self.max_entries = max_entries
+        self.raw_ips = {}
+        self.packed_ip_ids = {}
+        self.packed_ips = []
+        self.raw_user_agents = {}
+        self.instance_user_agent_ids = {}
+        self.instance_user_agents = []
+        self.raw_datetimes = {}
+        self.raw_escaped = {}
+        if distinct_paths:
+            self.path_registers = {}
+
+    def _classify(self, user_agent: Optional[str]) -> int:
+        if user_agent is None:
+            return _not_instance
+        instance_user_agent = classify_user_agent(user_agent)
+        if instance_user_agent is None:
+            return _not_instance
+        ua_id = self.instance_user_agent_ids.get(instance_user_agent)
+        if ua_id is None:
+            ua_id = len(self.instance_user_agents)
+            self.instance_user_agent_ids[instance_user_agent] = ua_id
+            self.instance_user_agents.append(instance_user_agent)
+        return ua_id
+
+    def user_agent_id(self, raw: bytes) -> int:
+        ua_id = self.raw_user_agents.get(raw)
+        if ua_id is not None:
+            return ua_id
+
+        try:
+            ua_id = self._classify(parse_user_agent(raw))
+        except (UnicodeError, ValueError):
+            ua_id = _not_instance
+
+        if len(self.raw_user_agents) >= self.max_entries:
+            self.raw_user_agents.clear()
+        self.raw_user_agents[raw] = ua_id
+        return ua_id
+
+    def decoded_user_agent_id(self, user_agent: Optional[str]) -> int:
+        """
+        Like `user_agent_id`, for formats that have already decoded the user agent.
+        Shares the raw user agent cache, since keys of different types never collide.
+        """
+        ua_id = self.raw_user_agents.get(user_agent)
+        if ua_id is not None:
+            return ua_id
+
+        ua_id = self._classify(user_agent)
+
+        if len(self.raw_user_agents) >= self.max_entries:
+            self.raw_user_agents.clear()
+        self.raw_user_agents[user_agent] = ua_id
+        return ua_id
+
+    def ip_id(self, raw: bytes) -> int:
+        """
+        :raises UnicodeError, OSError: if the IP can't be parsed.
+        """
+        ip_id = self.raw_ips.get(raw)
+        if ip_id is not None:
+            return ip_id
+
+        ip_id = self.packed_ip_id(parse_ip(raw))
+
+        if len(self.raw_ips) >= self.max_entries:
+            self.raw_ips.clear()
+        self.raw_ips[raw] = ip_id
+        return ip_id
+
+    def packed_ip_id(self, ip: bytes) -> int:
+        ip_id = self.packed_ip_ids.get(ip)
+        if ip_id is None:
+            ip_id = len(self.packed_ips)
+            self.packed_ip_ids[ip] = ip_id
+            self.packed_ips.append(ip)
+        return ip_id
+
+    def trim(self) -> None:
+        """
+        Start over with IP IDs if there are more than `max_entries` of them, and likewise for
+        instance user agent IDs, so that floods of distinct IPs or user agents can't grow them
+        without bound. Only call this between chunks, since chunks hold IDs.
+        """
+        if len(self.packed_ips) > self.max_entries:
+            self.raw_ips.clear()
+            self.packed_ip_ids.clear()
+            self.packed_ips = []
+        if len(self.instance_user_agents) > self.max_entries:
+            self.raw_user_agents.clear()
+            self.instance_user_agent_ids.clear()
+            self.instance_user_agents = []
+
+    def epoch_and_offset(self, raw: bytes) -> Tuple[int, int]:
+        """
+        :raises UnicodeError, ValueError: if the datetime can't be parsed.
+        """
+        epoch_and_offset = self.raw_datetimes.get(raw)
+        if epoch_and_offset is not None:
+            return epoch_and_offset
+
+        epoch_and_offset = _epoch_and_offset(
+            datetime.strptime(raw.decode('ascii'), COMMON_DATETIME_FORMAT)
+        )
+
+        if len(self.raw_datetimes) >= self.max_entries:
+            self.raw_datetimes.clear()
+        self.raw_datetimes[raw] = epoch_and_offset
+        return epoch_and_offset
+
+    def decodes(self, raw: bytes) -> bool:
+        """
+        :return: Whether `unescape_decode` can decode a raw escaped field.
+        """
+        ok = self.raw_escaped.get(raw)
+        if ok is not None:
+            return ok
+
+        try:
+            unescape_decode(raw)
+            ok = True
+        except (UnicodeError, ValueError):
+            ok = False
+
+        if len(self.raw_escaped) >= self.max_entries:
+            self.raw_escaped.clear()
+        self.raw_escaped[raw] = ok
+        return ok
+
+    def path_register(self, path: Union[bytes, str]) -> Tuple[int, int]:
+        """
+        Hash a raw path the same way as the decoded path would be, so sketches match
+        `TrafficAcc.add_request`. Decoded paths share the cache, since keys of different types
+        never collide.
+        """
+        register = self.path_registers.get(path)
+        if register is not None:
+            return register
+
+        try:
+            decoded = unescape_decode(path) if isinstance(path, bytes) else path
+            register = hll_register(hll_hash(decoded))
+        except (UnicodeError, ValueError):
+            register = _no_path_register
+
+        if len(self.path_registers) >= self.max_entries:
+            self.path_registers.clear()
+        self.path_registers[path] = register
+        return register
+
+
+class _Chunk:
+    """
+    Columns for one chunk of log lines from instances.
+    """
+    # All columns are signed 64-bit, so NumPy can use them without copying.
+    ip_ids: array
+    ua_ids: array
+    epochs: array
+    offsets: array
+    statuses: array
+    sizes: array
+    # Distinct path sketch registers and ranks, if counting distinct paths.
+    path_registers: array
+    path_ranks: array
+
+    def __init__(self):
+        self.ip_ids = array('q')
+        self.ua_ids = array('q')
+        self.epochs = array('q')
+        self.offsets = array('q')
+        self.statuses = array('q')
+        self.sizes = array('q')
+        self.path_registers = array('q')
+        self.path_ranks = array('q')
+
+    def __len__(self) -> int:
+        return len(self.ip_ids)
+
+    def add_line(self, interner: _Interner, line: bytes) -> None:
+        match = COMBINED_RE.match(line)
+        if match is None:
+            return
+        raw_ip, raw_username, raw_datetime, raw_path, raw_status, raw_size, raw_referrer, \
+            raw_user_agent = match.group(
+                'ip', 'username', 'datetime', 'path', 'status', 'size', 'referrer', 'user_agent'
+            )
+
+        # Most lines aren't from instances, so check that before doing any other work.
+        ua_id = interner.user_agent_id(raw_user_agent)
+        if ua_id == _not_instance:
+            return
+
+        try:
+            ip_id = interner.ip_id(raw_ip)
+            epoch, offset = interner.epoch_and_offset(raw_datetime)
+        except (UnicodeError, OSError, ValueError):
+            return
+        if not (interner.decodes(raw_username)
+                and interner.decodes(raw_path)
+                and interner.decodes(raw_referrer)):
+            return
+
+        # The regex only matches digits for these.
+        self._append(ip_id, ua_id, epoch, offset, int(raw_status), int(raw_size))
+        if interner.path_registers is not None:
+            self._append_path(*interner.path_register(raw_path))
+
+    def add_record(self, interner: _Interner, log_record: Optional[LogRecord]) -> None:
+        if log_record is None:
+            return
+        ua_id = interner.decoded_user_agent_id(log_record.user_agent)
+        if ua_id == _not_instance:
+            return
+        epoch, offset = _epoch_and_offset(log_record.timestamp)
+        self._append(interner.packed_ip_id(log_record.ip), ua_id, epoch, offset,
+                     log_record.status, log_record.size)
+        if interner.path_registers is not None:
+            self._append_path(*interner.path_register(log_record.path))
+
+    def _append(self, ip_id: int, ua_id: int, epoch: int, offset: int,
+                status: int, size: int) -> None:
+        self.ip_ids.append(ip_id)
+        self.ua_ids.append(ua_id)
+        self.epochs.append(epoch)
+        self.offsets.append(offset)
+        self.statuses.append(status)
+        self.sizes.append(size)
+
+    def _append_path(self, register: int, rank: int) -> None:
+        self.path_registers.append(register)
+        self.path_ranks.append(rank)
+
+
+def _reduce_chunk(interner: _Interner, chunk: _Chunk, incoming_ips: IncomingIPsAcc) -> None:
+    """
+    Find the first and last times and traffic counts for each (IP, user agent) pair in a chunk,
+    and fold them into `incoming_ips`.
+
+    Ties between lines with the same time resolve to the earliest line for both the first and last
+    times, to match `TimeWindowAcc.add` when fed one line at a time.
+    Active days are the distinct (pair, local date) rows.
+    """
+    if len(chunk) == 0:
+        return
+
+    num_uas = len(interner.instance_user_agents)
+    keys = np.frombuffer(chunk.ip_ids, dtype=np.int64) * num_uas \
+        + np.frombuffer(chunk.ua_ids, dtype=np.int64)
+    epochs = np.frombuffer(chunk.epochs, dtype=np.int64)
+    offsets = np.frombuffer(chunk.offsets, dtype=np.int64)
+
+    # `np.lexsort` is stable, so within each group of equal keys and times,
+    # rows stay in line order.
+    min_order = np.lexsort((epochs, keys))
+    max_order = np.lexsort((-epochs, keys))
+
+    sorted_keys = keys[min_order]
+    starts = np.concatenate((
+        np.zeros(1, dtype=np.int64),
+        np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1,
+    ))
+    group_keys = sorted_keys[starts]
+    min_rows = min_order[starts]
+    max_rows = max_order[starts]
+
+    # Dates in each line's own time zone, as `TimeWindowAcc` and its freeze method see them.
+    ordinals = (epochs + offsets) // _seconds_per_day + _epoch_ordinal
+    key_days = np.unique(np.stack((keys, ordinals), axis=1), axis=0)
+
+    tzs: Dict[int, timezone] = {}
+
+    def to_datetime(epoch: int, offset: int) -> datetime:
+        tz = tzs.get(offset)
+        if tz is None:
+            tz = timezone(timedelta(seconds=offset))
+            tzs[offset] = tz
+        return datetime.fromtimestamp(epoch, tz)
+
+    # Traffic counters per group, laid out as in `TrafficAcc`.
+    groups = np.searchsorted(group_keys, keys)
+    statuses = np.frombuffer(chunk.statuses, dtype=np.int64)
+    status_classes = statuses // 100
+    status_slots = np.where((status_classes >= 1) & (status_classes <= 5), 1 + status_classes, 7)
+    counts = np.zeros((len(group_keys), TRAFFIC_SLOTS), dtype=np.int64)
+    np.add.at(counts, (groups, 0), 1)
+    np.add.at(counts, (groups, 1), np.frombuffer(chunk.sizes, dtype=np.int64))
+    np.add.at(counts, (groups, status_slots), 1)
+
+    # Highest rank for each (group, register), which is all a sketch keeps, sorted by group.
+    if incoming_ips.distinct_paths:
+        registers = np.frombuffer(chunk.path_registers, dtype=np.int64)
+        ranks = np.frombuffer(chunk.path_ranks, dtype=np.int64)
+        order = np.lexsort((ranks, registers, groups))
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = (groups[order][1:] != groups[order][:-1]) \
+            | (registers[order][1:] != registers[order][:-1])
+        path_groups = groups[order][last]
+        path_registers = registers[order][last]
+        path_ranks = ranks[order][last]
+
+    # Where each group's rows start in `key_days` and the sketch registers, plus where they end.
+    day_starts = np.append(np.searchsorted(key_days[:, 0], group_keys), len(key_days))
+    if incoming_ips.distinct_paths:
+        path_starts = np.searchsorted(path_groups, np.arange(len(group_keys) + 1))
+
+    # Fold groups into `incoming_ips` a slice at a time, so that only one slice's worth of
+    # accumulators exists before `incoming_ips` gets a chance to spill.
+    for lo in range(0, len(group_keys), _fold_slice_size):
+        hi = min(lo + _fold_slice_size, len(group_keys))
+        day_rows = key_days[day_starts[lo]:day_starts[hi], 1].tolist()
+        day_bounds = (day_starts[lo:hi + 1] - day_starts[lo]).tolist()
+        if incoming_ips.distinct_paths:
+            path_rows = list(zip(path_registers[path_starts[lo]:path_starts[hi]].tolist(),
+                                 path_ranks[path_starts[lo]:path_starts[hi]].tolist()))
+            path_bounds = (path_starts[lo:hi + 1] - path_starts[lo]).tolist()
+
+        for i, (key, min_epoch, min_offset, max_epoch, max_offset, group_counts) in enumerate(zip(
+                group_keys[lo:hi].tolist(),
+                epochs[min_rows[lo:hi]].tolist(), offsets[min_rows[lo:hi]].tolist(),
+                epochs[max_rows[lo:hi]].tolist(), offsets[max_rows[lo:hi]].tolist(),
+                counts[lo:hi].tolist())):
+            time_window = TimeWindowAcc(
+                min=to_datetime(min_epoch, min_offset),
+                max=to_datetime(max_epoch, max_offset),
+            )
+            for ordinal in day_rows[day_bounds[i]:day_bounds[i + 1]]:
+                time_window.days.add_day(ordinal)
+
+            paths: Optional[HyperLogLog] = None
+            if incoming_ips.distinct_paths:
+                paths = HyperLogLog()
+                for register, rank in path_rows[path_bounds[i]:path_bounds[i + 1]]:
+                    paths.add_register(register, rank)
+
+            ip_id, ua_id = divmod(key, num_uas)
+            incoming_ips.add(
+                interner.packed_ips[ip_id],
+                interner.instance_user_agents[ua_id],
+                time_window,
+                TrafficAcc(counts=array('q', group_counts), paths=paths),
+            )
+
+
+def _new_interner(incoming_ips: IncomingIPsAcc) -> _Interner:
+    max_entries = _max_raw_cache_entries
+    if isinstance(incoming_ips, SpillingIncomingIPsAcc):
+        max_entries = min(max_entries, incoming_ips.max_entries)
+    return _Interner(distinct_paths=incoming_ips.distinct_paths, max_entries=max_entries)
+
+
+def aggregate_log_file_batch(path: str,
+                             incoming_ips: IncomingIPsAcc,
+                             chunk_size: int = DEFAULT_CHUNK_SIZE,
+                             on_line: Optional[Callable[[int], None]] = None,
+                             log_format: str = AUTO,
+                             _interner: Optional[_Interner] = None) -> IncomingIPsAcc:
+    """
+    Fold one log file into `incoming_ips`, one chunk of lines at a time.
+    Produces the same result as `aggregate_log_records(parse_log_file(path), incoming_ips)`.
+
+    :param on_line: Called with the size in bytes of every line read, for progress reporting.
+    :param log_format: Name of a format in `fedimap.log_format.LOG_FORMATS`, or `AUTO`.
+    """
+    interner = _interner or _new_interner(incoming_ips)
+    if isinstance(incoming_ips, SpillingIncomingIPsAcc):
+        # A chunk can't have more pairs than lines, so this keeps a chunk's worth of pairs
+        # within the same budget as the accumulator.
+        chunk_size = min(chunk_size, incoming_ips.max_entries)
+    if log_format == AUTO:
+        log_format = detect_log_format(path)
+    parse_line = LOG_FORMATS[log_format]
+    with open(path, 'rb') as f:
+        chunk = _Chunk()
+        for line in f:
+            if on_line is not None:
+                on_line(len(line))
+            if log_format == 'combined':
+                chunk.add_line(interner, line)
+            else:
+                chunk.add_record(interner, parse_line(line))
+            if len(chunk) >= chunk_size:
+                _reduce_chunk(interner, chunk, incoming_ips)
+                interner.trim()
+                chunk = _Chunk()
+        _reduce_chunk(interner, chunk, incoming_ips)
+        interner.trim()
+    return incoming_ips
+
+
+def aggregate_log_files_batch(paths: Iterable[str],
+                              incoming_ips: Optional[IncomingIPsAcc] = None,
+                              chunk_size: int = DEFAULT_CHUNK_SIZE,
+                              on_line: Optional[Callable[[int], None]] = None,
+                              log_format: str = AUTO) -> IncomingIPsAcc:
+    """
+    Fold several log files into `incoming_ips`, sharing interned fields between files.
+    """
+    if incoming_ips is None:
+        incoming_ips = IncomingIPsAcc()
+    interner = _new_interner(incoming_ips)
+    for path in paths:
+        aggregate_log_file_batch(path, incoming_ips, chunk_size=chunk_size, on_line=on_line,
+                                 log_format=log_format, _interner=interner)
+    return incoming_ips
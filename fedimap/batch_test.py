@@ -0,0 +1,132 @@
+import os
+import socket
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from fedimap.access_log import parse_log_file
+from fedimap.batch import aggregate_log_files_batch
+from fedimap.incoming import IncomingIPsAcc, aggregate_log_records
+from fedimap.spill import SpillingIncomingIPsAcc
+
+_log_lines = [
+    br'12.34.56.78 - - [27/Dec/2018:18:20:28 +0000] "POST /inbox HTTP/1.1" 202 0 "-" '
+    br'"http.rb/3.3.0 (Mastodon/2.6.5; +https://example.org/)"',
+    br'12.34.56.78 - - [27/Dec/2018:18:10:00 +0000] "POST /inbox HTTP/1.1" 202 0 "-" '
+    br'"http.rb/3.3.0 (Mastodon/2.6.5; +https://example.org/)"',
+    # Same instant as the first line, but in a different time zone.
+    br'12.34.56.78 - - [28/Dec/2018:02:20:28 +0800] "POST /inbox HTTP/1.1" 202 0 "-" '
+    br'"http.rb/3.3.0 (Mastodon/2.6.5; +https://example.org/)"',
+    br'12.34.56.78 - - [29/Dec/2018:09:00:00 +0000] "GET /users/a HTTP/1.1" 200 728 "-" '
+    br'"http.rb/3.3.0"',
+    # Escaped path, which must hash the same in both modes.
+    br'12.34.56.78 - - [29/Dec/2018:09:00:01 +0000] "GET /users/\x22a\x22 HTTP/1.1" 404 12 "-" '
+    br'"http.rb/3.3.0"',
+    br'::1 - - [27/Dec/2018:19:00:36 +0000] "GET /ipv6 HTTP/1.1" 200 169 "-" '
+    br'"hackney/1.13.0"',
+    br'0::1 - - [26/Dec/2018:19:00:36 -0500] "GET /ipv6 HTTP/1.1" 200 169 "-" '
+    br'"hackney/1.13.0"',
+    # Usernames, paths, and referrers that don't decode get the whole line dropped in both modes.
+    br'::1 - \xff\xfe [28/Dec/2018:19:00:36 +0000] "GET /ipv6 HTTP/1.1" 200 169 "-" '
+    br'"hackney/1.13.0"',
+    br'::1 - - [28/Dec/2018:19:00:37 +0000] "GET /\xff HTTP/1.1" 200 169 "-" '
+    br'"hackney/1.13.0"',
+    br'::1 - - [28/Dec/2018:19:00:38 +0000] "GET /ipv6 HTTP/1.1" 200 169 "\xfe" '
+    br'"hackney/1.13.0"',
+    br'98.76.54.32 - - [27/Dec/2018:18:20:28 +0000] "GET /example HTTP/2.0" 200 728 "-" '
+    br'"curl/7.52.1"',
+    br'not a log line',
+]
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.log')
+        with os.fdopen(fd, 'wb') as f:
+            for line in _log_lines:
+                f.write(line + b'\n')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def assert_same_as_streaming(self, chunk_size, distinct_paths=False):
+        expected = aggregate_log_records(parse_log_file(self.path),
+                                         IncomingIPsAcc(distinct_paths=distinct_paths))
+        actual = aggregate_log_files_batch([self.path, self.path],
+                                           IncomingIPsAcc(distinct_paths=distinct_paths),
+                                           chunk_size=chunk_size)
+        aggregate_log_records(parse_log_file(self.path), expected)
+
+        self.assertEqual(actual.ips.keys(), expected.ips.keys())
+        for ip in expected.ips.keys():
+            self.assertEqual(actual.ips[ip].keys(), expected.ips[ip].keys())
+            for ua, time_window in expected.ips[ip].items():
+                self.assertEqual(actual.ips[ip][ua].min, time_window.min)
+                self.assertEqual(actual.ips[ip][ua].min.utcoffset(), time_window.min.utcoffset())
+                self.assertEqual(actual.ips[ip][ua].max, time_window.max)
+                self.assertEqual(actual.ips[ip][ua].max.utcoffset(), time_window.max.utcoffset())
+                self.assertEqual(actual.ips[ip][ua].days.freeze(), time_window.days.freeze())
+                self.assertEqual(actual.traffic(ip, ua).freeze(), expected.traffic(ip, ua).freeze())
+                if distinct_paths:
+                    self.assertEqual(actual.traffic(ip, ua).paths.registers,
+                                     expected.traffic(ip, ua).paths.registers)
+
+    def test_one_chunk(self):
+        self.assert_same_as_streaming(chunk_size=1024)
+
+    def test_many_chunks(self):
+        self.assert_same_as_streaming(chunk_size=2)
+
+    def test_distinct_paths(self):
+        self.assert_same_as_streaming(chunk_size=1024, distinct_paths=True)
+        self.assert_same_as_streaming(chunk_size=2, distinct_paths=True)
+
+    def test_spilling(self):
+        expected = aggregate_log_records(parse_log_file(self.path),
+                                         IncomingIPsAcc(distinct_paths=True))
+        aggregate_log_records(parse_log_file(self.path), expected)
+        # Chunks and interned IPs and user agents are limited to two entries as well.
+        actual = SpillingIncomingIPsAcc(max_entries=2, distinct_paths=True)
+        try:
+            aggregate_log_files_batch([self.path, self.path], actual, chunk_size=1024)
+            self.assertGreater(len(actual.runs), 1)
+            self.assertEqual(
+                [(ip, ua, time_window.min, time_window.max, time_window.days.freeze(),
+                  traffic.freeze(), traffic.paths.registers)
+                 for ip, ua, time_window, traffic in actual.items()],
+                [(ip, ua, time_window.min, time_window.max, time_window.days.freeze(),
+                  traffic.freeze(), traffic.paths.registers)
+                 for ip, ua, time_window, traffic in expected.items()],
+            )
+        finally:
+            actual.close()
+
+    def test_traffic(self):
+        incoming_ips = aggregate_log_files_batch([self.path])
+        ip = socket.inet_pton(socket.AF_INET, '12.34.56.78')
+        traffic = [incoming_ips.traffic(ip, ua).freeze() for ua in incoming_ips.ips[ip].keys()]
+        self.assertCountEqual(traffic, [
+            OrderedDict([('requests', 3), ('bytes', 0), ('status_2xx', 3), ('error_rate', 0.0)]),
+            OrderedDict([('requests', 2), ('bytes', 740), ('status_2xx', 1), ('status_4xx', 1),
+                         ('error_rate', 0.5)]),
+        ])
+
+    def test_json(self):
+        fd, json_path = tempfile.mkstemp(suffix='.log')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(br'{"time_local":"27/Dec/2018:18:20:28 +0000","remote_addr":"::1",'
+                        br'"request":"GET / HTTP/1.1","status":"200","body_bytes_sent":"1",'
+                        br'"http_user_agent":"hackney/1.13.0"}' + b'\n')
+            incoming_ips = aggregate_log_files_batch([self.path, json_path])
+        finally:
+            os.remove(json_path)
+        time_windows = incoming_ips.ips[socket.inet_pton(socket.AF_INET6, '::1')]
+        self.assertEqual(len(time_windows), 1)
+        time_window = next(iter(time_windows.values()))
+        self.assertEqual(time_window.days.freeze(), ['2018-12-26/2018-12-27'])
+
+    def test_ipv6_spellings_merged(self):
+        incoming_ips = aggregate_log_files_batch([self.path])
+        self.assertEqual(len(incoming_ips.ips[socket.inet_pton(socket.AF_INET6, '::1')]), 1)
+        self.assertNotIn(socket.inet_pton(socket.AF_INET, '98.76.54.32'), incoming_ips.ips)
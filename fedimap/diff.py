@@ -0,0 +1,169 @@
+"""
+Compare two maps written by fedimap.
+
+Both maps are streamed one instance at a time and merge-joined on domain, relying on fedimap
+writing instances sorted by domain, so memory use depends on the size of the changes
+rather than the size of the maps. Each top-level entry is parsed as YAML on its own,
+so indentation and key order within entries don't matter.
+"""
+
+__all__ = ['iter_map_entries', 'diff_instance', 'diff_maps', 'main']
+
+import argparse
+import sys
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+InstanceFrozen = Dict[str, Any]
+InstanceDiff = Dict[str, Any]
+
+# Fields compared as a whole, with old and new values reported when they change.
+_flag_fields = ('tls_cert_ok', 'instance_api_called')
+
+
+def _is_top_level_key(line: str) -> bool:
+    return bool(line.strip()) \
+        and not line[0].isspace() \
+        and not line.startswith(('#', '---', '...', '- '))
+
+
+def iter_map_entries(f: TextIO) -> Iterator[Tuple[str, InstanceFrozen]]:
+    """
+    Read a map one top-level entry at a time.
+
+    :raises ValueError: if entries aren't sorted by domain.
+    """
+    from ruamel.yaml import YAML
+
+    yaml = YAML(typ='safe')
+    chunk: List[str] = []
+    prev_domain: Optional[str] = None
+
+    def load_chunk() -> Iterator[Tuple[str, InstanceFrozen]]:
+        nonlocal prev_domain
+        doc = yaml.load(''.join(chunk))
+        if not doc:
+            return
+        for domain, instance in doc.items():
+            if prev_domain is not None and domain <= prev_domain:
+                raise ValueError('Map is not sorted by domain: {domain!r} after {prev!r}'.format(
+                    domain=domain, prev=prev_domain
+                ))
+            prev_domain = domain
+            yield domain, instance or {}
+
+    for line in f:
+        if _is_top_level_key(line) and chunk:
+            yield from load_chunk()
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        yield from load_chunk()
+
+
+def _versions(instance: InstanceFrozen) -> List[str]:
+    """
+    Versions used to be written as a list, and are now a map of version to active days.
+    """
+    versions = instance.get('versions') or []
+    return list(versions.keys()) if isinstance(versions, dict) else list(versions)
+
+
+def _ips(instance: InstanceFrozen) -> List[str]:
+    return list((instance.get('ips') or {}).keys())
+
+
+def diff_instance(old: Optional[InstanceFrozen],
+                  new: Optional[InstanceFrozen]) -> Optional[InstanceDiff]:
+    """
+    :return: Changes between two versions of one instance, or `None` if there are none.
+        An instance that's only in one of the maps is added or removed with all its IPs
+        and versions.
+    """
+    if old is None and new is None:
+        return None
+
+    diff: InstanceDiff = {}
+    if old is None:
+        diff['change'] = 'added'
+    elif new is None:
+        diff['change'] = 'removed'
+    else:
+        diff['change'] = 'changed'
+
+    old_ips = set(_ips(old or {}))
+    new_ips = set(_ips(new or {}))
+    old_versions = set(_versions(old or {}))
+    new_versions = set(_versions(new or {}))
+
+    lists = (
+        ('new_ips', new_ips - old_ips),
+        ('vanished_ips', old_ips - new_ips),
+        ('versions_added', new_versions - old_versions),
+        ('versions_removed', old_versions - new_versions),
+    )
+    for field, values in lists:
+        if values:
+            diff[field] = sorted(values)
+
+    if old is not None and new is not None:
+        for field in _flag_fields:
+            if old.get(field) != new.get(field):
+                diff[field] = {'old': old.get(field), 'new': new.get(field)}
+        if len(diff) == 1:
+            return None
+
+    return diff
+
+
+def diff_maps(old_entries: Iterable[Tuple[str, InstanceFrozen]],
+              new_entries: Iterable[Tuple[str, InstanceFrozen]]
+              ) -> Iterator[Tuple[str, InstanceDiff]]:
+    """
+    Merge-join two sorted streams of map entries.
+
+    :return: Changes per domain, in domain order.
+    """
+    old_iter = iter(old_entries)
+    new_iter = iter(new_entries)
+    old_entry = next(old_iter, None)
+    new_entry = next(new_iter, None)
+
+    while old_entry is not None or new_entry is not None:
+        if new_entry is None or (old_entry is not None and old_entry[0] < new_entry[0]):
+            domain, diff = old_entry[0], diff_instance(old_entry[1], None)
+            old_entry = next(old_iter, None)
+        elif old_entry is None or new_entry[0] < old_entry[0]:
+            domain, diff = new_entry[0], diff_instance(None, new_entry[1])
+            new_entry = next(new_iter, None)
+        else:
+            domain, diff = new_entry[0], diff_instance(old_entry[1], new_entry[1])
+            old_entry = next(old_iter, None)
+            new_entry = next(new_iter, None)
+
+        if diff is not None:
+            yield domain, diff
+
+
+def main(args: List[str]) -> None:
+    """
+    Entry point for `python -m fedimap diff OLD NEW`.
+    Writes changes as YAML, one domain at a time.
+    """
+    parser = argparse.ArgumentParser(
+        prog='fedimap diff',
+        description='Show added and removed instances, new and vanished IPs, and changes in '
+                    'versions, TLS cert checks, and instance API calls between two maps.',
+    )
+    parser.add_argument('old', metavar='OLD', help='earlier map')
+    parser.add_argument('new', metavar='NEW', help='later map')
+    options = parser.parse_args(args)
+
+    from ruamel.yaml import YAML
+
+    yaml = YAML()
+    yaml.indent(mapping=2, sequence=2, offset=1)
+
+    with open(options.old, encoding='utf-8') as old_f, \
+            open(options.new, encoding='utf-8') as new_f:
+        for domain, diff in diff_maps(iter_map_entries(old_f), iter_map_entries(new_f)):
+            yaml.dump({domain: diff}, sys.stdout)
@@ -0,0 +1,95 @@
+import io
+import unittest
+
+from fedimap.diff import diff_maps, iter_map_entries
+
+_old = '''\
+example.com:
+  urls: []
+  tls_cert_ok: false
+  instance_api_called: false
+  first_seen: '2018-12-01'
+  last_seen: '2018-12-03'
+  versions:
+   - Mastodon 2.6.4
+  ips:
+    1.2.3.4:
+      inbound: true
+      forward: false
+      reverse: false
+      first_seen: '2018-12-01'
+      last_seen: '2018-12-03'
+example.net:
+  urls: []
+  tls_cert_ok: true
+  instance_api_called: true
+  versions:
+    Pleroma 1.0:
+     - 2018-12-01
+  ips:
+    5.6.7.8:
+      inbound: true
+example.org:
+  tls_cert_ok: true
+  ips:
+    ::1:
+      inbound: true
+'''
+
+# Different indentation and key order, and versions in the newer format.
+_new = '''\
+example.com:
+    ips:
+        1.2.3.4: {inbound: true, forward: true, reverse: false}
+        1.2.3.5: {inbound: true}
+    versions:
+        Mastodon 2.6.5: [2018-12-04]
+    tls_cert_ok: true
+    instance_api_called: false
+example.net:
+  tls_cert_ok: true
+  instance_api_called: true
+  versions:
+    Pleroma 1.0:
+     - 2018-12-01/2018-12-02
+  ips:
+    5.6.7.8:
+      inbound: true
+      forward: true
+example.social:
+  ips:
+    9.9.9.9:
+      inbound: true
+'''
+
+
+class TestDiff(unittest.TestCase):
+    def test_diff(self):
+        diffs = dict(diff_maps(iter_map_entries(io.StringIO(_old)),
+                               iter_map_entries(io.StringIO(_new))))
+        self.assertEqual(diffs, {
+            'example.com': {
+                'change': 'changed',
+                'new_ips': ['1.2.3.5'],
+                'versions_added': ['Mastodon 2.6.5'],
+                'versions_removed': ['Mastodon 2.6.4'],
+                'tls_cert_ok': {'old': False, 'new': True},
+            },
+            'example.org': {
+                'change': 'removed',
+                'vanished_ips': ['::1'],
+            },
+            'example.social': {
+                'change': 'added',
+                'new_ips': ['9.9.9.9'],
+            },
+        })
+
+    def test_identical(self):
+        self.assertEqual(list(diff_maps(iter_map_entries(io.StringIO(_old)),
+                                        iter_map_entries(io.StringIO(_old)))), [])
+
+    def test_unsorted(self):
+        unsorted = 'b.example:\n  ips: {}\na.example:\n  ips: {}\n'
+        with self.assertRaises(ValueError):
+            list(iter_map_entries(io.StringIO(unsorted)))
@@ -0,0 +1,149 @@
+"""
+Network lookups that turn IPs and hostnames from access logs into evidence:
+reverse DNS, forward DNS, TLS cert checks, and instance API probes.
+"""
+
+__all__ = ['ForwardDNSResult', 'reverse_dns', 'forward_dns', 'tls_evidence', 'probe']
+
+import logging
+import socket
+from datetime import datetime, timezone
+from typing import List, NamedTuple, Optional
+
+from fedimap.evidence import ReverseDNSEvidence, ForwardDNSEvidence, TLSCertCheckEvidence, \
+    InstanceAPIEvidence, InstanceEvidence
+from fedimap.instance_api import UNKNOWN_SERVER_TYPE, get_instance_info
+from fedimap.net import fmt_ip, extract_hostname_and_port, get_domain
+from fedimap.tls import TLSCertInfo
+
+_logger = logging.getLogger(__name__)
+
+
+def reverse_dns(ip: bytes) -> List[ReverseDNSEvidence]:
+    all_evidence = []
+    ip_str = fmt_ip(ip)
+    try:
+        time = datetime.now(timezone.utc)
+        hostname, aliases, addresses = socket.gethostbyaddr(ip_str)
+        aliases = [alias for alias in aliases
+                   if not alias.endswith('.in-addr.arpa')
+                   and not alias.endswith('.ip6.arpa')]
+        if addresses != [ip_str]:
+            # TODO: when would this happen?
+            _logger.warning('%(ip_str)s resolved to multiple IPs: %(addresses)r',
+                            {'ip_str': ip_str, 'addresses': addresses})
+
+        for alias in [hostname] + aliases:
+            all_evidence.append(ReverseDNSEvidence(
+                ip=ip,
+                hostname=alias,
+                domain=get_domain(alias),
+                time=time,
+            ))
+    except OSError:
+        _logger.warning(
+            "Exception on reverse DNS lookup for %(ip_str)s!",
+            {'ip_str': ip_str},
+            exc_info=True
+        )
+    return all_evidence
+
+
+# `getaddrinfo` errors that mean the name definitely has no addresses,
+# as opposed to a timeout or a server failure.
+_no_such_name_errors = frozenset(
+    getattr(socket, name)
+    for name in ('EAI_NONAME', 'EAI_NODATA')
+    if hasattr(socket, name)
+)
+
+
+class ForwardDNSResult(NamedTuple):
+    evidence: List[ForwardDNSEvidence]
+    # Whether the hostname has any address at all, including IPv6 ones, which aren't recorded
+    # as evidence. If it doesn't, connecting to it would fail too.
+    # `None` if the lookup failed in a way that might succeed if retried.
+    exists: Optional[bool]
+
+
+def forward_dns(hostname: str) -> ForwardDNSResult:
+    """
+    Resolve a hostname once, for both IPv4 evidence and whether it exists at all.
+    """
+    all_evidence = []
+    exists: Optional[bool] = False
+    try:
+        time = datetime.now(timezone.utc)
+        # noinspection PyArgumentList
+        for af, _, _, _, sockaddr in socket.getaddrinfo(hostname, None,
+                                                        family=socket.AF_UNSPEC,
+                                                        type=socket.SOCK_STREAM,
+                                                        proto=socket.IPPROTO_IP):
+            exists = True
+            if af != socket.AF_INET:
+                continue
+            ip_str = sockaddr[0]
+            ip = socket.inet_pton(af, ip_str)
+            all_evidence.append(ForwardDNSEvidence(
+                ip=ip,
+                hostname=hostname,
+                domain=get_domain(hostname),
+                time=time,
+            ))
+    except OSError as e:
+        if not (isinstance(e, socket.gaierror) and e.errno in _no_such_name_errors):
+            exists = None
+        _logger.warning(
+            "Exception on forward DNS lookup for %(hostname)s!",
+            {'hostname': hostname},
+            exc_info=True
+        )
+    return ForwardDNSResult(evidence=all_evidence, exists=exists)
+
+
+def tls_evidence(hostname: str, port: int,
+                 cert_info: Optional[TLSCertInfo]) -> List[TLSCertCheckEvidence]:
+    if cert_info is None:
+        return []
+    return [TLSCertCheckEvidence(
+        hostname=hostname,
+        domain=get_domain(hostname),
+        port=port,
+        time=cert_info.time,
+        not_after=cert_info.not_after,
+        subject_alt_names=tuple(cert_info.subject_alt_names),
+    )]
+
+
+def probe(hostname: str, port: int) -> List[InstanceEvidence]:
+    """
+    Call instance info APIs for a hostname and port.
+    """
+    _logger.debug("Probing %(hostname)s:%(port)d", {'hostname': hostname, 'port': port})
+    all_evidence = []
+    time = datetime.now(timezone.utc)
+    instance_user_agent = get_instance_info(hostname, port)
+
+    if instance_user_agent is not None:
+        all_evidence.append(TLSCertCheckEvidence(
+            hostname=hostname,
+            domain=get_domain(hostname),
+            port=port,
+            time=time,
+        ))
+
+        if instance_user_agent.server != UNKNOWN_SERVER_TYPE \
+                and instance_user_agent.url is not None:
+            reported_hostname_and_port = extract_hostname_and_port(instance_user_agent.url)
+            if reported_hostname_and_port is not None:
+                reported_hostname, reported_port = reported_hostname_and_port
+                if hostname == reported_hostname and port == reported_port:
+                    all_evidence.append(InstanceAPIEvidence(
+                        hostname=hostname,
+                        domain=get_domain(hostname),
+                        port=port,
+                        instance_user_agent=instance_user_agent,
+                        time=time,
+                    ))
+
+    return all_evidence
@@ -1,26 +1,116 @@
-from datetime import datetime
+from array import array
+from datetime import date, datetime
 # OrderedDict doesn't show in IntelliJ for some reason.
 # noinspection PyUnresolvedReferences
-from typing import NamedTuple, Optional, OrderedDict, Union
+from typing import List, NamedTuple, Optional, OrderedDict, Tuple, Union
 
+from fedimap.sketch import HyperLogLog
 from fedimap.user_agent import InstanceUserAgent
 
 __all__ = [
-    'TimeWindowFrozen', 'TimeWindowAcc', 'UserAgentEvidence', 'ForwardDNSEvidence',
-    'ReverseDNSEvidence', 'TLSCertCheckEvidence', 'InstanceAPIEvidence', 'IPEvidence',
-    'InstanceEvidence', 'Evidence'
+    'ActiveDaysFrozen', 'ActiveDaysAcc', 'TimeWindowFrozen', 'TimeWindowAcc', 'TRAFFIC_SLOTS',
+    'add_request_counts', 'TrafficFrozen', 'TrafficAcc', 'UserAgentEvidence',
+    'ForwardDNSEvidence', 'ReverseDNSEvidence', 'TLSCertCheckEvidence', 'InstanceAPIEvidence',
+    'IPEvidence', 'InstanceEvidence', 'Evidence'
 ]
 
 
+ActiveDaysFrozen = List[str]
+
+
+class ActiveDaysAcc:
+    """
+    Accumulator that tracks which days something was seen on, as a bitmap.
+    Bit `i` of `bits` is set if the day with proleptic Gregorian ordinal `base + i` was seen,
+    so a few weeks of activity fits in a few bytes, and merging is a shift and an OR.
+    """
+    base: Optional[int] = None
+    bits: int = 0
+
+    def __init__(self, base: Optional[int] = None, bits: int = 0):
+        if (base is None) != (bits == 0):
+            raise ValueError()
+        self.base = base
+        self.bits = bits
+
+    def __repr__(self) -> str:
+        return '{module}.{qualname}({ranges!r})'.format(
+            module=self.__class__.__module__,
+            qualname=self.__class__.__qualname__,
+            ranges=self.ranges(),
+        )
+
+    def is_empty(self) -> bool:
+        return self.base is None
+
+    def add_day(self, ordinal: int) -> None:
+        if self.base is None:
+            self.base = ordinal
+            self.bits = 1
+        elif ordinal >= self.base:
+            self.bits |= 1 << (ordinal - self.base)
+        else:
+            self.bits = (self.bits << (self.base - ordinal)) | 1
+            self.base = ordinal
+
+    def add(self, x: Union[date, 'ActiveDaysAcc']) -> None:
+        if isinstance(x, ActiveDaysAcc):
+            if x.is_empty():
+                return
+            if self.base is None:
+                self.base = x.base
+                self.bits = x.bits
+            elif x.base >= self.base:
+                self.bits |= x.bits << (x.base - self.base)
+            else:
+                self.bits = (self.bits << (self.base - x.base)) | x.bits
+                self.base = x.base
+        else:
+            self.add_day(x.toordinal())
+
+    def ranges(self) -> List[Tuple[date, date]]:
+        """
+        :return: Runs of consecutive active days, as (first, last) pairs (inclusive), in order.
+        """
+        ranges = []
+        bits = self.bits
+        offset = 0
+        while bits:
+            # Skip to the next set bit, then to the next clear bit after it.
+            skip = (bits & -bits).bit_length() - 1
+            bits >>= skip
+            offset += skip
+            run = (~bits & (bits + 1)).bit_length() - 1
+            ranges.append((
+                date.fromordinal(self.base + offset),
+                date.fromordinal(self.base + offset + run - 1),
+            ))
+            bits >>= run
+            offset += run
+        return ranges
+
+    def freeze(self) -> ActiveDaysFrozen:
+        """
+        :return: Single days as `YYYY-MM-DD`, and runs of days as ISO 8601 intervals.
+        """
+        return [
+            first.isoformat() if first == last
+            else '{first}/{last}'.format(first=first.isoformat(), last=last.isoformat())
+            for first, last in self.ranges()
+        ]
+
+
 TimeWindowFrozen = OrderedDict[str, str]
 
 
 class TimeWindowAcc:
     """
-    Accumulator that tracks the min and max times seen (inclusive).
+    Accumulator that tracks the min and max times seen (inclusive),
+    and the days in between that anything was seen on.
     """
     min: Optional[datetime] = None
     max: Optional[datetime] = None
+    days: ActiveDaysAcc
 
     # noinspection PyShadowingBuiltins
     def __init__(self, min: Optional[datetime] = None, max: Optional[datetime] = None):
@@ -28,6 +118,10 @@ class TimeWindowAcc:
             raise ValueError()
         self.min = min
         self.max = max
+        self.days = ActiveDaysAcc()
+        if min is not None:
+            self.days.add(min.date())
+            self.days.add(max.date())
 
     def __repr__(self) -> str:
         args = []
@@ -49,7 +143,9 @@ class TimeWindowAcc:
             if not x.is_empty():
                 self.add(x.min)
                 self.add(x.max)
+                self.days.add(x.days)
         else:
+            self.days.add(x.date())
             if self.is_empty():
                 self.min = x
                 self.max = x
@@ -68,6 +164,98 @@ class TimeWindowAcc:
         return od
 
 
+# Number of counters per traffic count array: requests, bytes, status classes 1xx through 5xx,
+# and other statuses (such as 0 when a log format doesn't record one).
+TRAFFIC_SLOTS = 8
+_requests_slot = 0
+_bytes_slot = 1
+_other_status_slot = 7
+
+
+def add_request_counts(counts: array, offset: int, status: int, size: int) -> None:
+    """
+    Count one request in the traffic counters starting at `offset` in `counts`.
+    """
+    counts[offset + _requests_slot] += 1
+    counts[offset + _bytes_slot] += size
+    status_class = status // 100
+    if 1 <= status_class <= 5:
+        counts[offset + 1 + status_class] += 1
+    else:
+        counts[offset + _other_status_slot] += 1
+
+
+TrafficFrozen = OrderedDict[str, Union[int, float]]
+
+
+class TrafficAcc:
+    """
+    Accumulator for request, byte, and status class counts, kept in one compact integer array,
+    and optionally an approximate count of distinct paths.
+    """
+    counts: array
+    paths: Optional[HyperLogLog] = None
+
+    def __init__(self, counts: Optional[array] = None, paths: Optional[HyperLogLog] = None):
+        if counts is None:
+            counts = array('q', bytes(8 * TRAFFIC_SLOTS))
+        elif len(counts) != TRAFFIC_SLOTS:
+            raise ValueError()
+        self.counts = counts
+        self.paths = paths
+
+    def __repr__(self) -> str:
+        return '{module}.{qualname}({counts!r})'.format(
+            module=self.__class__.__module__,
+            qualname=self.__class__.__qualname__,
+            counts=self.counts.tolist(),
+        )
+
+    @property
+    def requests(self) -> int:
+        return self.counts[_requests_slot]
+
+    @property
+    def bytes(self) -> int:
+        return self.counts[_bytes_slot]
+
+    @property
+    def errors(self) -> int:
+        """
+        :return: Number of requests with 4xx or 5xx statuses.
+        """
+        return self.counts[5] + self.counts[6]
+
+    def add_request(self, status: int, size: int, path: Optional[str] = None) -> None:
+        add_request_counts(self.counts, 0, status, size)
+        if self.paths is not None and path is not None:
+            self.paths.add(path)
+
+    def add(self, x: 'TrafficAcc') -> None:
+        for i, count in enumerate(x.counts):
+            self.counts[i] += count
+        if x.paths is not None:
+            if self.paths is None:
+                self.paths = x.paths.copy()
+            else:
+                self.paths.add(x.paths)
+
+    def freeze(self) -> TrafficFrozen:
+        od = OrderedDict()
+        od['requests'] = self.requests
+        od['bytes'] = self.bytes
+        for status_class in range(1, 6):
+            count = self.counts[1 + status_class]
+            if count:
+                od['status_{status_class}xx'.format(status_class=status_class)] = count
+        if self.counts[_other_status_slot]:
+            od['status_other'] = self.counts[_other_status_slot]
+        od['error_rate'] = round(self.errors / self.requests, 4) if self.requests else 0.0
+        if self.paths is not None:
+            od['distinct_paths'] = self.paths.count()
+        return od
+
+
 class UserAgentEvidence(NamedTuple):
     """
     Evidence from server access logs that a given instance was trying to access this server.
@@ -79,6 +267,7 @@ class UserAgentEvidence(NamedTuple):
     port: int
     instance_user_agent: InstanceUserAgent
     time_window: TimeWindowAcc
+    traffic: TrafficAcc
 
 
 class ForwardDNSEvidence(NamedTuple):
@@ -112,6 +301,9 @@ class TLSCertCheckEvidence(NamedTuple):
     domain: str
     port: int
     time: datetime
+    # From a handshake-only check. Not known when the evidence comes from an instance API call.
+    not_after: Optional[datetime] = None
+    subject_alt_names: Tuple[str, ...] = ()
 
 
 class InstanceAPIEvidence(NamedTuple):
@@ -0,0 +1,83 @@
+import unittest
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+
+from fedimap.evidence import ActiveDaysAcc, TimeWindowAcc, TrafficAcc
+from fedimap.sketch import HyperLogLog
+
+
+class TestActiveDays(unittest.TestCase):
+    def test_ranges(self):
+        acc = ActiveDaysAcc()
+        for day in [12, 5, 6, 7, 10, 3, 13, 6]:
+            acc.add(date(2018, 12, day))
+        self.assertEqual(acc.freeze(), [
+            '2018-12-03',
+            '2018-12-05/2018-12-07',
+            '2018-12-10',
+            '2018-12-12/2018-12-13',
+        ])
+
+    def test_merge(self):
+        a = ActiveDaysAcc()
+        a.add(date(2018, 12, 30))
+        a.add(date(2018, 12, 31))
+        b = ActiveDaysAcc()
+        b.add(date(2018, 12, 28))
+        b.add(date(2019, 1, 1))
+        a.add(b)
+        a.add(ActiveDaysAcc())
+        self.assertEqual(a.freeze(), ['2018-12-28', '2018-12-30/2019-01-01'])
+
+    def test_empty(self):
+        self.assertEqual(ActiveDaysAcc().freeze(), [])
+
+
+class TestTimeWindow(unittest.TestCase):
+    def test_days_in_local_time(self):
+        acc = TimeWindowAcc()
+        acc.add(datetime(2018, 12, 27, 23, 0, tzinfo=timezone.utc))
+        acc.add(datetime(2018, 12, 29, 1, 0, tzinfo=timezone(timedelta(hours=8))))
+        self.assertEqual(acc.days.freeze(), ['2018-12-27', '2018-12-29'])
+
+    def test_merge_days(self):
+        a = TimeWindowAcc()
+        for day in [1, 2, 5]:
+            a.add(datetime(2018, 12, day, tzinfo=timezone.utc))
+        b = TimeWindowAcc()
+        b.add(a)
+        self.assertEqual(b.days.freeze(), ['2018-12-01/2018-12-02', '2018-12-05'])
+
+
+class TestTraffic(unittest.TestCase):
+    def test_counts(self):
+        acc = TrafficAcc()
+        acc.add_request(200, 100)
+        acc.add_request(404, 10)
+        acc.add_request(503, 0)
+        acc.add_request(0, 5)
+        self.assertEqual(acc.freeze(), OrderedDict([
+            ('requests', 4),
+            ('bytes', 115),
+            ('status_2xx', 1),
+            ('status_4xx', 1),
+            ('status_5xx', 1),
+            ('status_other', 1),
+            ('error_rate', 0.5),
+        ]))
+
+    def test_merge_distinct_paths(self):
+        a = TrafficAcc()
+        a.add_request(200, 1, '/a')
+        b = TrafficAcc(paths=HyperLogLog())
+        b.add_request(200, 1, '/a')
+        b.add_request(200, 1, '/b')
+        a.add(b)
+        a.add(b)
+        self.assertEqual(a.requests, 5)
+        self.assertEqual(a.freeze()['distinct_paths'], 2)
+        # Merging copies the sketch rather than sharing it.
+        self.assertIsNot(a.paths, b.paths)
+
+    def test_empty(self):
+        self.assertEqual(TrafficAcc().freeze()['error_rate'], 0.0)
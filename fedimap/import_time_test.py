@@ -0,0 +1,48 @@
+import re
+import subprocess
+import sys
+import unittest
+from typing import Dict
+
+# Cumulative import time budget for the CLI entry point, in microseconds.
+# Measured at around 60 ms with all heavy dependencies deferred, versus 240 ms without.
+_budget_us = 150_000
+
+# Dependencies that should only be imported by the stage that needs them.
+_deferred_modules = ['numpy', 'publicsuffix2', 'requests', 'ruamel.yaml', 'ssl', 'validators']
+
+_importtime_re = re.compile(r'^import time:\s+(?P<self>\d+) \|\s+(?P<cumulative>\d+) \| '
+                            r'(?P<indent>\s*)(?P<module>\S+)$')
+
+
+def _import_times(module: str) -> Dict[str, int]:
+    """
+    Import a module in a fresh interpreter with `-X importtime`.
+
+    :return: Map of every module imported to its cumulative import time in microseconds.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {module}'.format(module=module)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = _importtime_re.match(line)
+        if match is not None:
+            times[match.group('module')] = int(match.group('cumulative'))
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    def test_heavy_imports_deferred(self):
+        times = _import_times('fedimap.__main__')
+        for module in _deferred_modules:
+            self.assertNotIn(module, times)
+
+    def test_budget(self):
+        # Take the best of a few runs to smooth out noise from a busy machine.
+        best = min(_import_times('fedimap.__main__')['fedimap.__main__'] for _ in range(3))
+        self.assertLess(best, _budget_us)
@@ -0,0 +1,149 @@
+"""
+Aggregation of access log records into time windows and traffic counts
+per IP and instance user agent.
+"""
+
+__all__ = ['IncomingIPs', 'IncomingIPsAcc', 'aggregate_log_records', 'user_agent_sort_key']
+
+import json
+from array import array
+from datetime import datetime
+from typing import Callable, DefaultDict, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from fedimap.access_log import LogRecord
+from fedimap.evidence import TRAFFIC_SLOTS, TimeWindowAcc, TrafficAcc, add_request_counts
+from fedimap.sketch import HyperLogLog
+from fedimap.user_agent import classify_user_agent, InstanceUserAgent
+
+
+IncomingIPs = DefaultDict[bytes, DefaultDict[InstanceUserAgent, TimeWindowAcc]]
+
+_zero_traffic_counts = array('q', bytes(8 * TRAFFIC_SLOTS))
+
+
+def user_agent_sort_key(instance_user_agent: InstanceUserAgent) -> str:
+    """
+    Instance user agents can't be compared directly because some fields may be `None`.
+    This key orders them consistently, and doubles as a serialized form.
+    """
+    return json.dumps(instance_user_agent, ensure_ascii=False)
+
+
+class IncomingIPsAcc:
+    """
+    Accumulator for time windows and traffic per IP and instance user agent, held in memory.
+    """
+    ips: IncomingIPs
+    # Number of distinct (IP, instance user agent) pairs.
+    num_entries: int = 0
+    # Map of (IP, instance user agent) pair to its entry number, in order of first appearance.
+    entry_ids: Dict[Tuple[bytes, InstanceUserAgent], int]
+    # `TRAFFIC_SLOTS` traffic counters per entry, by entry number.
+    traffic_counts: array
+    # Distinct path sketch per entry, by entry number, or `None` if not counting distinct paths.
+    traffic_paths: Optional[List[HyperLogLog]] = None
+    # Called with each (IP, instance user agent) pair the first time it's held in memory,
+    # so work on it can start before aggregation is done.
+    # May be called again for the same pair after it's been spilled.
+    on_new_entry: Optional[Callable[[bytes, InstanceUserAgent], None]] = None
+
+    # noinspection PyTypeHints
+    def __init__(self, distinct_paths: bool = False):
+        self.ips = DefaultDict(lambda: DefaultDict(TimeWindowAcc))
+        self.entry_ids = {}
+        self.traffic_counts = array('q')
+        if distinct_paths:
+            self.traffic_paths = []
+
+    @property
+    def distinct_paths(self) -> bool:
+        return self.traffic_paths is not None
+
+    def add(self,
+            ip: bytes,
+            instance_user_agent: InstanceUserAgent,
+            x: Union[datetime, TimeWindowAcc],
+            traffic: Union[LogRecord, TrafficAcc, None] = None) -> None:
+        """
+        :param traffic: A log record to count as one request, or counts to add.
+        """
+        key = (ip, instance_user_agent)
+        entry_id = self.entry_ids.get(key)
+        if entry_id is None:
+            entry_id = self.num_entries
+            self.entry_ids[key] = entry_id
+            self.num_entries += 1
+            self.traffic_counts.extend(_zero_traffic_counts)
+            if self.traffic_paths is not None:
+                self.traffic_paths.append(HyperLogLog())
+            if self.on_new_entry is not None:
+                self.on_new_entry(ip, instance_user_agent)
+        self.ips[ip][instance_user_agent].add(x)
+
+        if traffic is None:
+            return
+        offset = entry_id * TRAFFIC_SLOTS
+        if isinstance(traffic, TrafficAcc):
+            for i, count in enumerate(traffic.counts):
+                self.traffic_counts[offset + i] += count
+            if self.traffic_paths is not None and traffic.paths is not None:
+                self.traffic_paths[entry_id].add(traffic.paths)
+        else:
+            add_request_counts(self.traffic_counts, offset, traffic.status, traffic.size)
+            if self.traffic_paths is not None:
+                self.traffic_paths[entry_id].add(traffic.path)
+
+    def traffic(self, ip: bytes, instance_user_agent: InstanceUserAgent) -> TrafficAcc:
+        """
+        :return: Copy of the traffic counters for an (IP, instance user agent) pair.
+        """
+        entry_id = self.entry_ids[(ip, instance_user_agent)]
+        offset = entry_id * TRAFFIC_SLOTS
+        return TrafficAcc(
+            counts=self.traffic_counts[offset:offset + TRAFFIC_SLOTS],
+            paths=self.traffic_paths[entry_id].copy() if self.traffic_paths is not None else None,
+        )
+
+    def items(self) -> Iterator[Tuple[bytes, InstanceUserAgent, TimeWindowAcc, TrafficAcc]]:
+        """
+        :return: Every (IP, instance user agent, time window, traffic), sorted by IP and then
+            user agent, so that output doesn't depend on the order logs were read in.
+        """
+        for ip in sorted(self.ips.keys()):
+            time_windows = self.ips[ip]
+            for instance_user_agent in sorted(time_windows.keys(), key=user_agent_sort_key):
+                yield ip, instance_user_agent, time_windows[instance_user_agent], \
+                    self.traffic(ip, instance_user_agent)
+
+    def clear(self) -> None:
+        """
+        Forget everything held in memory.
+        """
+        self.ips.clear()
+        self.entry_ids.clear()
+        self.traffic_counts = array('q')
+        if self.traffic_paths is not None:
+            self.traffic_paths = []
+        self.num_entries = 0
+
+    def close(self) -> None:
+        """
+        Release any resources held by the accumulator.
+        """
+        pass
+
+
+def aggregate_log_records(log_records: Iterable[LogRecord],
+                          incoming_ips: IncomingIPsAcc) -> IncomingIPsAcc:
+    """
+    Fold log records from instances into `incoming_ips`, one record at a time.
+    Records without a user agent, or with one that doesn't look like an instance, are ignored.
+    """
+    for log_record in log_records:
+        if log_record.user_agent is None:
+            continue
+        instance_user_agent = classify_user_agent(log_record.user_agent)
+        if instance_user_agent is None:
+            continue
+        incoming_ips.add(log_record.ip, instance_user_agent, log_record.timestamp, log_record)
+    return incoming_ips
@@ -4,8 +4,6 @@ import re
 from typing import Optional
 from urllib.parse import urlsplit, urlunsplit
 
-import requests
-
 from fedimap.user_agent import InstanceUserAgent
 # TODO: overloading this for now
 
@@ -31,6 +29,8 @@ def get_instance_info(hostname: str, port: int) -> Optional[InstanceUserAgent]:
 
     TODO: could be faster if we had a hint as to what the server was before talking to it?
     """
+    import requests  # Deferred: slow to import and only needed for instance API calls.
+
     api_scheme = 'https'
     api_netloc = hostname if port == 443 else '{hostname}:{port}'.format(
         hostname=hostname, port=port
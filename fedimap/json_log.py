@@ -0,0 +1,170 @@
+"""
+JSON lines access log parser.
+
+Understands two layouts:
+
+- nginx with `escape=json` and a `log_format` whose keys are the names of the nginx variables
+  they hold, like `{"remote_addr":"$remote_addr","time_local":"$time_local",...}`.
+  Any of `time_local`, `time_iso8601`, or `msec` can provide the timestamp,
+  and either `request` or `request_method`/`request_uri`/`server_protocol` the request line.
+- Caddy 2's native access log, where request details are nested under `request`
+  and `ts` is a Unix timestamp (or an ISO 8601 string with a custom `time_format`).
+
+Only the remote IP, timestamp, and user agent are required. Other `LogRecord` fields are filled in
+when present, and otherwise left empty. Lines with fields of the wrong JSON type, or with strings
+that aren't valid Unicode (escaped lone surrogates), are skipped like any other unparseable line.
+
+Uses `orjson` if it's installed, since decoding is most of the cost of parsing a line.
+
+See https://nginx.org/en/docs/http/ngx_http_log_module.html#log_format
+See https://caddyserver.com/docs/caddyfile/directives/log
+"""
+
+__all__ = ['parse_json_log_line']
+
+import json
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from fedimap.access_log import LogRecord, COMMON_DATETIME_FORMAT, parse_ip
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+
+def _str(x: Any) -> str:
+    """
+    Check that a field is a string that can be encoded as UTF-8.
+    `orjson` rejects escaped lone surrogates like `\\ud800`, but `json` decodes them into strings
+    that can't be written out later, so they're rejected here for both.
+
+    :raises TypeError, UnicodeError: if it isn't.
+    """
+    if not isinstance(x, str):
+        raise TypeError(type(x))
+    x.encode('utf-8')
+    return x
+
+
+def _empty(x: Any) -> Optional[str]:
+    """
+    nginx writes empty variables as an empty string, or a dash for some of them.
+    """
+    if x is None or x == '' or x == '-':
+        return None
+    return _str(x) if isinstance(x, str) else str(x)
+
+
+def _int(x: Any) -> int:
+    return int(x) if x not in (None, '', '-') else 0
+
+
+def _ip(ip_str: str) -> bytes:
+    """
+    :raises UnicodeError, OSError: if the IP can't be parsed.
+    """
+    return parse_ip(_str(ip_str).encode('ascii'))
+
+
+def _strip_port(addr: str) -> str:
+    """
+    Remove the port from `host:port` or `[host]:port`, as used by Caddy's `remote_addr`.
+    """
+    if addr.startswith('['):
+        return addr[1:addr.index(']')]
+    if addr.count(':') == 1:
+        return addr.partition(':')[0]
+    return addr
+
+
+def _epoch(x: Any) -> datetime:
+    return datetime.fromtimestamp(float(x), timezone.utc)
+
+
+def _iso8601(s: str) -> datetime:
+    s = _str(s)
+    # `datetime.fromisoformat` doesn't accept `Z` before Python 3.11.
+    if s.endswith('Z'):
+        s = s[:-1] + '+00:00'
+    return datetime.fromisoformat(s)
+
+
+def _parse_caddy(doc: Dict[str, Any]) -> LogRecord:
+    request = doc['request']
+
+    ip_str = request.get('client_ip') or request.get('remote_ip')
+    if not ip_str:
+        ip_str = _strip_port(_str(request['remote_addr']))
+
+    ts = doc['ts']
+    timestamp = _iso8601(ts) if isinstance(ts, str) else _epoch(ts)
+
+    headers = request.get('headers') or {}
+    if not isinstance(headers, dict):
+        raise TypeError(type(headers))
+    user_agents = headers.get('User-Agent') or [None]
+    referrers = headers.get('Referer') or [None]
+
+    return LogRecord(
+        ip=_ip(ip_str),
+        timestamp=timestamp,
+        method=_str(request.get('method', '')),
+        path=_str(request.get('uri', '')),
+        protocol=_str(request.get('proto', '')),
+        status=_int(doc.get('status')),
+        size=_int(doc.get('size')),
+        username=_empty(doc.get('user_id')),
+        referrer=_empty(referrers[0]),
+        user_agent=_empty(user_agents[0]),
+    )
+
+
+def _parse_nginx(doc: Dict[str, Any]) -> LogRecord:
+    if 'time_local' in doc:
+        timestamp = datetime.strptime(_str(doc['time_local']), COMMON_DATETIME_FORMAT)
+    elif 'time_iso8601' in doc:
+        timestamp = _iso8601(doc['time_iso8601'])
+    else:
+        timestamp = _epoch(doc['msec'])
+
+    if 'request' in doc:
+        method, _, rest = _str(doc['request']).partition(' ')
+        path, _, protocol = rest.rpartition(' ')
+    else:
+        method = _str(doc.get('request_method', ''))
+        path = _str(doc.get('request_uri', ''))
+        protocol = _str(doc.get('server_protocol', ''))
+
+    return LogRecord(
+        ip=_ip(doc['remote_addr']),
+        timestamp=timestamp,
+        method=method,
+        path=path,
+        protocol=protocol,
+        status=_int(doc.get('status')),
+        size=_int(doc.get('body_bytes_sent', doc.get('bytes_sent'))),
+        username=_empty(doc.get('remote_user')),
+        referrer=_empty(doc.get('http_referer')),
+        user_agent=_empty(doc.get('http_user_agent')),
+    )
+
+
+def parse_json_log_line(line: bytes) -> Optional[LogRecord]:
+    """
+    Parse one JSON log line and return a `LogRecord` if possible, `None` otherwise.
+    """
+    try:
+        doc = _loads(line)
+        if not isinstance(doc, dict):
+            return None
+        if isinstance(doc.get('request'), dict):
+            return _parse_caddy(doc)
+        else:
+            return _parse_nginx(doc)
+
+    # JSON decode errors are subclasses of `ValueError`.
+    except (KeyError, TypeError, UnicodeError, OSError, ValueError):
+        return None
@@ -0,0 +1,122 @@
+import json
+import os
+import socket
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+from fedimap import json_log
+
+from fedimap.access_log import LogRecord
+from fedimap.json_log import parse_json_log_line
+from fedimap.log_format import detect_log_format
+
+_nginx_line = br'{"time_local":"27/Dec/2018:18:20:28 +0000","remote_addr":"12.34.56.78",' \
+              br'"remote_user":"","request":"GET /example HTTP/2.0","status":"200",' \
+              br'"body_bytes_sent":"728","http_referer":"",' \
+              br'"http_user_agent":"http.rb/3.3.0 (Mastodon/2.6.5; +https://example.org/)"}'
+
+_caddy_line = br'{"level":"info","ts":1545934828.5241024,"logger":"http.log.access.log0",' \
+              br'"msg":"handled request","request":{"remote_ip":"::1","remote_port":"41342",' \
+              br'"proto":"HTTP/2.0","method":"GET","host":"example.org","uri":"/example",' \
+              br'"headers":{"User-Agent":["curl/7.52.1"],"Accept":["*/*"]}},' \
+              br'"bytes_read":0,"user_id":"","duration":0.000929675,"size":728,"status":200,' \
+              br'"resp_headers":{"Content-Type":["text/html"]}}'
+
+_combined_line = br'12.34.56.78 - - [27/Dec/2018:18:20:28 +0000] "GET /example HTTP/2.0" ' \
+                 br'200 728 "-" "curl/7.52.1"'
+
+
+class TestJSONLog(unittest.TestCase):
+    def test_nginx(self):
+        expected = LogRecord(
+            ip=socket.inet_pton(socket.AF_INET, '12.34.56.78'),
+            timestamp=datetime(2018, 12, 27, 18, 20, 28, tzinfo=timezone.utc),
+            method='GET',
+            path='/example',
+            protocol='HTTP/2.0',
+            status=200,
+            size=728,
+            user_agent='http.rb/3.3.0 (Mastodon/2.6.5; +https://example.org/)'
+        )
+        self.assertEqual(parse_json_log_line(_nginx_line), expected)
+
+    def test_nginx_escapes(self):
+        # nginx escapes quotes and control characters, but writes UTF-8 as is.
+        log_record = parse_json_log_line((
+            r'{"time_iso8601":"2018-12-27T18:20:28+00:00","remote_addr":"12.34.56.78",'
+            r'"request_method":"GET","request_uri":"/example","server_protocol":"HTTP/1.1",'
+            r'"status":"200","bytes_sent":"900","http_user_agent":"\"hi\" ∑"}'
+        ).encode('utf-8'))
+        self.assertEqual(log_record.user_agent, '"hi" ∑')
+        self.assertEqual(log_record.size, 900)
+
+    def test_caddy(self):
+        log_record = parse_json_log_line(_caddy_line)
+        self.assertEqual(log_record.ip, socket.inet_pton(socket.AF_INET6, '::1'))
+        self.assertEqual(log_record.timestamp,
+                         datetime(2018, 12, 27, 18, 20, 28, 524102, tzinfo=timezone.utc))
+        self.assertEqual(log_record.user_agent, 'curl/7.52.1')
+        self.assertEqual(log_record.status, 200)
+        self.assertIsNone(log_record.username)
+
+    def test_caddy_remote_addr(self):
+        log_record = parse_json_log_line(
+            br'{"ts":"2018-12-27T18:20:28Z","request":{"remote_addr":"[::1]:41342",'
+            br'"method":"GET","uri":"/","proto":"HTTP/1.1","headers":{}},"status":404}'
+        )
+        self.assertEqual(log_record.ip, socket.inet_pton(socket.AF_INET6, '::1'))
+        self.assertIsNone(log_record.user_agent)
+
+    def test_invalid(self):
+        self.assertIsNone(parse_json_log_line(b'{"remote_addr": "12.34.56.78"'))
+        self.assertIsNone(parse_json_log_line(b'[]'))
+        self.assertIsNone(parse_json_log_line(b'{"remote_addr": "nope", "msec": "1.0"}'))
+        self.assertIsNone(parse_json_log_line(_combined_line))
+
+    def test_wrong_types(self):
+        for line in [
+            br'{"remote_addr":1,"msec":"1.0","http_user_agent":"curl/7.52.1"}',
+            br'{"remote_addr":"::1","time_iso8601":5,"http_user_agent":"curl/7.52.1"}',
+            br'{"remote_addr":"::1","time_local":5,"http_user_agent":"curl/7.52.1"}',
+            br'{"remote_addr":"::1","msec":"1.0","request":[1],"http_user_agent":"curl/7.52.1"}',
+            br'{"remote_addr":"::1","msec":"1.0","request_uri":{},"http_user_agent":"curl/7.52.1"}',
+            br'{"ts":1.0,"request":{"remote_ip":1}}',
+            br'{"ts":1.0,"request":{"remote_addr":5}}',
+            br'{"ts":[],"request":{"remote_ip":"::1"}}',
+            br'{"ts":1.0,"request":{"remote_ip":"::1","headers":[1]}}',
+            br'{"ts":1.0,"request":{"remote_ip":"::1","uri":1}}',
+        ]:
+            with self.subTest(line=line):
+                self.assertIsNone(parse_json_log_line(line))
+
+    def test_lone_surrogate(self):
+        line = br'{"remote_addr":"::1","msec":"1.0","http_user_agent":"http.rb/4.0\ud800"}'
+        self.assertIsNone(parse_json_log_line(line))
+        # The standard library decoder accepts lone surrogates, unlike `orjson`.
+        with mock.patch.object(json_log, '_loads', json.loads):
+            self.assertIsNone(parse_json_log_line(line))
+            self.assertIsNotNone(parse_json_log_line(_nginx_line))
+            self.assertIsNotNone(parse_json_log_line(_caddy_line))
+
+
+class TestDetectLogFormat(unittest.TestCase):
+    def detect(self, *lines):
+        fd, path = tempfile.mkstemp(suffix='.log')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for line in lines:
+                    f.write(line + b'\n')
+            return detect_log_format(path)
+        finally:
+            os.remove(path)
+
+    def test_json(self):
+        self.assertEqual(self.detect(b'', _nginx_line, _caddy_line), 'json')
+
+    def test_combined(self):
+        self.assertEqual(self.detect(_combined_line, b'garbage'), 'combined')
+
+    def test_empty(self):
+        self.assertEqual(self.detect(), 'combined')
@@ -0,0 +1,55 @@
+"""
+Registry of access log formats, and detection of which one a log file uses.
+"""
+
+__all__ = ['LOG_FORMATS', 'AUTO', 'detect_log_format', 'parse_log_file']
+
+from itertools import islice
+from typing import Callable, Dict, Iterator, Optional
+
+from fedimap import access_log
+from fedimap.access_log import LogRecord, parse_log_line
+from fedimap.json_log import parse_json_log_line
+
+# Map of log format name to line parser.
+LOG_FORMATS: Dict[str, Callable[[bytes], Optional[LogRecord]]] = {
+    'combined': parse_log_line,
+    'json': parse_json_log_line,
+}
+
+# Pseudo-format that means "look at the file and decide".
+AUTO = 'auto'
+
+# Number of non-blank lines to look at when detecting a file's format.
+_detect_lines = 16
+
+
+def detect_log_format(path: str) -> str:
+    """
+    Guess the format of a log file from its first lines.
+    Each candidate format gets a point for every line it can parse, and the best one wins,
+    with Combined Log Format as the default for empty or unrecognizable files.
+    """
+    with open(path, 'rb') as f:
+        sample = list(islice((line for line in f if line.strip()), _detect_lines))
+
+    scores = {
+        name: sum(1 for line in sample if parse_line(line) is not None)
+        for name, parse_line in LOG_FORMATS.items()
+    }
+    best = max(scores, key=lambda name: scores[name])
+    return best if scores[best] > 0 else 'combined'
+
+
+def parse_log_file(path: str,
+                   log_format: str = AUTO,
+                   on_line: Optional[Callable[[int], None]] = None) -> Iterator[LogRecord]:
+    """
+    Parse a log file in any known format.
+
+    :param log_format: Name of a format in `LOG_FORMATS`, or `AUTO` to detect it.
+    :param on_line: Called with the size in bytes of every line read, for progress reporting.
+    """
+    if log_format == AUTO:
+        log_format = detect_log_format(path)
+    return access_log.parse_log_file(path, on_line=on_line, parse_line=LOG_FORMATS[log_format])
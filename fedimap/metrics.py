@@ -0,0 +1,55 @@
+"""
+Localhost HTTP endpoint serving progress counters in Prometheus text format.
+"""
+
+__all__ = ['MetricsServer']
+
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from fedimap.progress import Progress
+
+_logger = logging.getLogger(__name__)
+
+
+class MetricsServer:
+    """
+    Serves `Progress.render_metrics` over HTTP on localhost from a daemon thread.
+    """
+    progress: Progress
+    server: HTTPServer
+    thread: threading.Thread
+
+    def __init__(self, progress: Progress, port: int, host: str = '127.0.0.1'):
+        self.progress = progress
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = progress.render_metrics().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                _logger.debug(format, *args)
+
+        self.server = HTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='fedimap-metrics', daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -2,9 +2,6 @@ import socket
 from typing import Optional, Tuple
 from urllib.parse import urlsplit
 
-import publicsuffix2
-import validators
-
 __all__ = ['af_for_ip', 'fmt_ip', 'extract_hostname_and_port', 'get_domain']
 
 
@@ -23,6 +20,8 @@ def extract_hostname_and_port(instance_url: str) -> Optional[Tuple[str, int]]:
     TODO: are there any servers that would use HTTP during normal operation?
     TODO: how many places could we just pass an HTTP or HTTPS URL straight through?
     """
+    import validators  # Deferred: slow to import and only needed once logs are parsed.
+
     url = urlsplit(instance_url)
     if url.scheme != 'https':
         return None
@@ -59,6 +58,8 @@ def get_domain(hostname: str) -> str:
 
     There's one current exception to the PSL: masto.host.
     """
+    import publicsuffix2  # Deferred: loads the public suffix list on import.
+
     # Note: `publicsuffix2.get_public_suffix` really should have been called `get_private_suffix`.
     # `get_public_suffix('example.com') sounds like it'd return `com`,
     # but actually returns `example.com`.
@@ -0,0 +1,173 @@
+"""
+Pipelined discovery: network lookups start as soon as log parsing first sees an IP or hostname,
+so the run takes about as long as the slower of parsing and network work, not both.
+
+The parsing loop hands each new (IP, instance user agent) pair to `DiscoveryPipeline.add_entry`,
+which queues reverse DNS for new IPs, forward DNS for new hostnames, and TLS cert checks followed by
+probes for new hostnames and ports on a thread pool. Probes wait for their hostname's forward DNS
+lookup, so the `exact` plan can still skip TLS checks and probes of hostnames that don't exist,
+and probes of hostnames and ports whose TLS cert failed verification.
+The `conclusive` plan needs every hostname seen before it can pick which to probe first,
+so it isn't supported here.
+
+Produces the same evidence as running the stages one after another.
+"""
+
+__all__ = ['DEFAULT_WORKERS', 'DiscoveryPipeline']
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, DefaultDict, Dict, List, Set, Tuple
+
+from fedimap import discovery
+from fedimap.discovery import ForwardDNSResult, tls_evidence
+from fedimap.evidence import Evidence, InstanceEvidence, IPEvidence, ReverseDNSEvidence
+from fedimap.net import extract_hostname_and_port
+from fedimap.planner import EXACT, FULL, report_plan
+from fedimap.progress import Progress
+from fedimap.tls import TLSCheckResult, check_tls_cert
+from fedimap.user_agent import InstanceUserAgent
+
+DEFAULT_WORKERS = 16
+
+
+class DiscoveryPipeline:
+    """
+    Runs network lookups on a thread pool while logs are still being parsed.
+
+    `add_entry` must be called from a single thread. Lookup functions can be replaced for testing.
+    """
+    mode: str
+    progress: Progress
+    # IPs, hostnames, and hostname and port pairs already queued.
+    ips: Set[bytes]
+    hostnames: Dict[str, 'Future[ForwardDNSResult]']
+    hostnames_and_ports: Set[Tuple[str, int]]
+    futures: List['Future[List[Evidence]]']
+    # Map of stage name to number of lookups done, number skipped,
+    # and number of those skips that may change the output.
+    done: DefaultDict[str, int]
+    skipped: DefaultDict[str, int]
+    lossy: DefaultDict[str, int]
+
+    # noinspection PyTypeHints
+    def __init__(self,
+                 progress: Progress,
+                 mode: str = EXACT,
+                 workers: int = DEFAULT_WORKERS,
+                 reverse_dns: Callable[[bytes], List[ReverseDNSEvidence]] = discovery.reverse_dns,
+                 forward_dns: Callable[[str], ForwardDNSResult] = discovery.forward_dns,
+                 check_tls: Callable[[str, int], TLSCheckResult] = check_tls_cert,
+                 probe: Callable[[str, int], List[InstanceEvidence]] = discovery.probe):
+        if mode not in (FULL, EXACT):
+            raise ValueError(mode)
+        self.mode = mode
+        self.progress = progress
+        self.ips = set()
+        self.hostnames = {}
+        self.hostnames_and_ports = set()
+        self.futures = []
+        self.done = DefaultDict(int)
+        self.skipped = DefaultDict(int)
+        self.lossy = DefaultDict(int)
+        self._reverse_dns = reverse_dns
+        self._forward_dns = forward_dns
+        self._check_tls = check_tls
+        self._probe = probe
+        # Guards counters updated from worker threads.
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='fedimap-discovery')
+        for stage in ('forward_dns', 'reverse_dns', 'tls', 'probe'):
+            progress.start_stage(stage)
+
+    def _advance(self, stage: str, skipped: bool = False, lossy: bool = False) -> None:
+        with self._lock:
+            if skipped:
+                self.skipped[stage] += 1
+                if lossy:
+                    self.lossy[stage] += 1
+            else:
+                self.done[stage] += 1
+            self.progress.advance(stage)
+
+    def _run_reverse_dns(self, ip: bytes) -> List[IPEvidence]:
+        evidence = self._reverse_dns(ip)
+        self._advance('reverse_dns')
+        return evidence
+
+    def _run_forward_dns(self, hostname: str) -> ForwardDNSResult:
+        result = self._forward_dns(hostname)
+        self._advance('forward_dns')
+        return result
+
+    def _run_probe(self, hostname: str, port: int) -> List[InstanceEvidence]:
+        # Forward DNS for this hostname was queued first, so it's running or done by now.
+        if self.mode != FULL and self.hostnames[hostname].result().exists is False:
+            self._advance('tls', skipped=True)
+            self._advance('probe', skipped=True)
+            return []
+
+        result = self._check_tls(hostname, port)
+        evidence: List[InstanceEvidence] = list(tls_evidence(hostname, port, result.info))
+        self._advance('tls')
+        if self.mode != FULL and result.valid is False:
+            self._advance('probe', skipped=True, lossy=True)
+            return evidence
+
+        evidence.extend(self._probe(hostname, port))
+        self._advance('probe')
+        return evidence
+
+    def _submit(self, stage: str, fn: Callable, *args) -> Future:
+        self.progress.stages[stage].total += 1
+        return self._executor.submit(fn, *args)
+
+    def add_entry(self, ip: bytes, instance_user_agent: InstanceUserAgent) -> None:
+        """
+        Queue lookups for anything in this entry that hasn't been seen before.
+        """
+        if ip not in self.ips:
+            self.ips.add(ip)
+            self.futures.append(self._submit('reverse_dns', self._run_reverse_dns, ip))
+
+        if instance_user_agent.url is None:
+            return
+        hostname_and_port = extract_hostname_and_port(instance_user_agent.url)
+        if hostname_and_port is None or hostname_and_port in self.hostnames_and_ports:
+            return
+        self.hostnames_and_ports.add(hostname_and_port)
+        hostname, port = hostname_and_port
+
+        if hostname not in self.hostnames:
+            self.hostnames[hostname] = self._submit('forward_dns', self._run_forward_dns,
+                                                    hostname)
+        # TLS cert checks run in the same task as the probe they gate.
+        self.progress.stages['tls'].total += 1
+        self.futures.append(self._submit('probe', self._run_probe, hostname, port))
+
+    def results(self) -> List[Evidence]:
+        """
+        Wait for every queued lookup to finish.
+
+        :return: Evidence from all of them.
+        """
+        self._executor.shutdown(wait=True)
+        all_evidence: List[Evidence] = []
+        for future in self.hostnames.values():
+            all_evidence.extend(future.result().evidence)
+        for future in self.futures:
+            all_evidence.extend(future.result())
+        report_plan(self.mode, self.done, self.skipped, self.lossy)
+        return all_evidence
+
+    def cancel(self) -> None:
+        """
+        Drop queued lookups without waiting for them, such as when parsing fails.
+        Lookups already running still finish in the background.
+        """
+        for future in self.futures:
+            future.cancel()
+        for future in self.hostnames.values():
+            future.cancel()
+        self._executor.shutdown(wait=False)
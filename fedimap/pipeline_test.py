@@ -0,0 +1,143 @@
+import threading
+import unittest
+from datetime import datetime, timezone
+from typing import List
+
+from fedimap.discovery import ForwardDNSResult
+from fedimap.evidence import ForwardDNSEvidence, InstanceAPIEvidence, ReverseDNSEvidence
+from fedimap.pipeline import DiscoveryPipeline
+from fedimap.planner import CONCLUSIVE, FULL
+from fedimap.progress import Progress
+from fedimap.tls import TLSCertInfo, TLSCheckResult
+from fedimap.user_agent import InstanceUserAgent
+
+_time = datetime(2018, 12, 28, tzinfo=timezone.utc)
+
+_ip_a = bytes([192, 0, 2, 1])
+_ip_b = bytes([192, 0, 2, 2])
+
+
+def _ua(url: str) -> InstanceUserAgent:
+    return InstanceUserAgent(pattern_name='test', server='mastodon', url=url)
+
+
+class FakeNetwork:
+    """
+    Stands in for DNS and instance APIs, and records what was looked up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: List[tuple] = []
+
+    def reverse_dns(self, ip: bytes) -> List[ReverseDNSEvidence]:
+        with self.lock:
+            self.calls.append(('reverse_dns', ip))
+        return [ReverseDNSEvidence(ip=ip, hostname='example.org', domain='example.org',
+                                   time=_time)]
+
+    def forward_dns(self, hostname: str) -> ForwardDNSResult:
+        with self.lock:
+            self.calls.append(('forward_dns', hostname))
+        if hostname.startswith('gone.'):
+            return ForwardDNSResult(evidence=[], exists=False)
+        return ForwardDNSResult(evidence=[ForwardDNSEvidence(
+            ip=_ip_a, hostname=hostname, domain='example.org', time=_time,
+        )], exists=True)
+
+    def check_tls(self, hostname: str, port: int) -> TLSCheckResult:
+        with self.lock:
+            self.calls.append(('check_tls', hostname, port))
+        if hostname.startswith('gone.') or hostname.startswith('slow.'):
+            return TLSCheckResult(info=None, valid=None)
+        if hostname.startswith('badcert.'):
+            return TLSCheckResult(info=None, valid=False)
+        return TLSCheckResult(info=TLSCertInfo(time=_time, not_after=_time,
+                                               subject_alt_names=[hostname]), valid=True)
+
+    def probe(self, hostname: str, port: int) -> List[InstanceAPIEvidence]:
+        with self.lock:
+            self.calls.append(('probe', hostname, port))
+        return [InstanceAPIEvidence(hostname=hostname, domain='example.org', port=port,
+                                    instance_user_agent=_ua('https://' + hostname), time=_time)]
+
+
+def _pipeline(network: FakeNetwork, mode: str = 'exact') -> DiscoveryPipeline:
+    return DiscoveryPipeline(
+        Progress(interval=0),
+        mode=mode,
+        workers=4,
+        reverse_dns=network.reverse_dns,
+        forward_dns=network.forward_dns,
+        check_tls=network.check_tls,
+        probe=network.probe,
+    )
+
+
+class TestDiscoveryPipeline(unittest.TestCase):
+    def test_each_lookup_once(self):
+        network = FakeNetwork()
+        pipeline = _pipeline(network)
+        pipeline.add_entry(_ip_a, _ua('https://example.org'))
+        pipeline.add_entry(_ip_a, _ua('https://example.org'))
+        pipeline.add_entry(_ip_b, _ua('https://example.org'))
+        pipeline.add_entry(_ip_b, _ua('https://example.org:8443'))
+        pipeline.add_entry(_ip_b, InstanceUserAgent(pattern_name='test', server='mastodon'))
+        evidence = pipeline.results()
+
+        self.assertCountEqual(network.calls, [
+            ('reverse_dns', _ip_a),
+            ('reverse_dns', _ip_b),
+            ('forward_dns', 'example.org'),
+            ('check_tls', 'example.org', 443),
+            ('probe', 'example.org', 443),
+            ('check_tls', 'example.org', 8443),
+            ('probe', 'example.org', 8443),
+        ])
+        self.assertEqual(len(evidence), 7)
+        self.assertEqual(pipeline.progress.stages['probe'].done, 2)
+        self.assertEqual(pipeline.progress.stages['probe'].queued, 0)
+
+    def test_exact_skips_nonexistent_hostnames(self):
+        network = FakeNetwork()
+        pipeline = _pipeline(network)
+        pipeline.add_entry(_ip_a, _ua('https://gone.example.org'))
+        evidence = pipeline.results()
+
+        self.assertNotIn(('check_tls', 'gone.example.org', 443), network.calls)
+        self.assertNotIn(('probe', 'gone.example.org', 443), network.calls)
+        self.assertEqual(len(evidence), 1)
+        self.assertEqual(pipeline.skipped['probe'], 1)
+
+    def test_exact_skips_failed_tls(self):
+        network = FakeNetwork()
+        pipeline = _pipeline(network)
+        pipeline.add_entry(_ip_a, _ua('https://badcert.example.org'))
+        evidence = pipeline.results()
+
+        self.assertIn(('check_tls', 'badcert.example.org', 443), network.calls)
+        self.assertNotIn(('probe', 'badcert.example.org', 443), network.calls)
+        self.assertEqual(len(evidence), 2)
+        self.assertEqual(pipeline.progress.stages['tls'].done, 1)
+        self.assertEqual(pipeline.lossy['probe'], 1)
+
+    def test_exact_probes_after_tls_timeout(self):
+        network = FakeNetwork()
+        pipeline = _pipeline(network)
+        pipeline.add_entry(_ip_a, _ua('https://slow.example.org'))
+        pipeline.results()
+
+        self.assertIn(('probe', 'slow.example.org', 443), network.calls)
+        self.assertEqual(pipeline.skipped['probe'], 0)
+
+    def test_full_probes_nonexistent_hostnames(self):
+        network = FakeNetwork()
+        pipeline = _pipeline(network, mode=FULL)
+        pipeline.add_entry(_ip_a, _ua('https://gone.example.org'))
+        pipeline.results()
+
+        self.assertIn(('probe', 'gone.example.org', 443), network.calls)
+
+    def test_conclusive_unsupported(self):
+        with self.assertRaises(ValueError):
+            _pipeline(FakeNetwork(), mode=CONCLUSIVE)
@@ -0,0 +1,238 @@
+"""
+Planning for the network stages, so they don't repeat or waste work.
+
+The planner builds a graph of domains, hostnames, ports, and IPs from the user agent evidence,
+and hands out lookups in an order that lets it skip the ones that can't matter:
+
+- `full`: every reverse DNS lookup, forward DNS lookup, and probe, as if unplanned.
+- `exact` (default): skips TLS checks and probes of hostnames that forward DNS showed don't exist,
+  since they can't connect. Forward DNS and the existence check share one resolution.
+  Also skips probes of hostnames and ports whose TLS cert failed verification, since the instance
+  API calls verify the cert against the same CAs. Those skips are lossy in the rare case that the
+  API calls would still get through, such as through a proxy that presents its own certs, so
+  they're reported separately. Timeouts and other handshake failures don't skip probes.
+  Otherwise, output is the same as `full`.
+- `conclusive`: also stops probing a domain once one probe has both verified its TLS cert and
+  identified it through its instance API, and skips reverse DNS for IPs that forward DNS already
+  tied to an instance hostname. Output loses the extra `urls` from the skipped probes
+  and `reverse` flags from the skipped lookups, so all of these skips are lossy.
+"""
+
+__all__ = ['FULL', 'EXACT', 'CONCLUSIVE', 'PLAN_MODES', 'EvidenceGraph', 'EvidencePlanner',
+           'report_plan']
+
+import logging
+from typing import DefaultDict, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from fedimap.evidence import UserAgentEvidence, ForwardDNSEvidence, TLSCertCheckEvidence, \
+    InstanceAPIEvidence, InstanceEvidence
+
+FULL = 'full'
+EXACT = 'exact'
+CONCLUSIVE = 'conclusive'
+PLAN_MODES = [FULL, EXACT, CONCLUSIVE]
+
+_logger = logging.getLogger(__name__)
+
+
+class EvidenceGraph:
+    """
+    Links between IPs, hostnames, ports, and domains from user agent evidence.
+    """
+    # Map of domain to hostnames on it.
+    domain_hostnames: DefaultDict[str, Set[str]]
+    # Map of hostname to its domain.
+    hostname_domains: Dict[str, str]
+    # Map of hostname to ports instances on it said they used.
+    hostname_ports: DefaultDict[str, Set[int]]
+    # Map of hostname to IPs that sent requests claiming to be from it.
+    hostname_ips: DefaultDict[str, Set[bytes]]
+
+    # noinspection PyTypeHints
+    def __init__(self, user_agent_evidence: Iterable[UserAgentEvidence] = ()):
+        self.domain_hostnames = DefaultDict(set)
+        self.hostname_domains = {}
+        self.hostname_ports = DefaultDict(set)
+        self.hostname_ips = DefaultDict(set)
+        for evidence in user_agent_evidence:
+            self.add(evidence)
+
+    def add(self, evidence: UserAgentEvidence) -> None:
+        self.domain_hostnames[evidence.domain].add(evidence.hostname)
+        self.hostname_domains[evidence.hostname] = evidence.domain
+        self.hostname_ports[evidence.hostname].add(evidence.port)
+        self.hostname_ips[evidence.hostname].add(evidence.ip)
+
+    def hostnames(self) -> List[str]:
+        return sorted(self.hostname_domains.keys())
+
+    def probes(self) -> List[Tuple[str, int]]:
+        """
+        :return: Every (hostname, port) pair, grouped by domain, and within each domain
+            with the hostnames we've seen the most IPs for first, since they're the most likely
+            to be the instance's main hostname.
+        """
+        probes = []
+        for domain in sorted(self.domain_hostnames.keys()):
+            hostnames = sorted(self.domain_hostnames[domain],
+                               key=lambda hostname: (-len(self.hostname_ips[hostname]), hostname))
+            for hostname in hostnames:
+                for port in sorted(self.hostname_ports[hostname]):
+                    probes.append((hostname, port))
+        return probes
+
+
+class EvidencePlanner:
+    """
+    Hands out network lookups, skipping the ones the plan mode says can't matter,
+    and counts the work done and saved.
+    """
+    mode: str
+    graph: EvidenceGraph
+    possible_instance_ips: Set[bytes]
+    # Hostnames that forward DNS showed have no addresses.
+    nonexistent_hostnames: Set[str]
+    # IPs that forward DNS of an instance hostname resolved to.
+    forward_confirmed_ips: Set[bytes]
+    # Domains with both a verified TLS cert and matching instance API info.
+    conclusive_domains: Set[str]
+    # Hostnames and ports whose TLS cert failed verification.
+    tls_invalid: Set[Tuple[str, int]]
+    # Domains with a verified TLS cert, and domains with matching instance API info.
+    tls_domains: Set[str]
+    api_domains: Set[str]
+    # Map of stage name to number of lookups done, number skipped,
+    # and number of those skips that may change the output.
+    done: DefaultDict[str, int]
+    skipped: DefaultDict[str, int]
+    lossy: DefaultDict[str, int]
+
+    # noinspection PyTypeHints
+    def __init__(self,
+                 possible_instance_ips: Iterable[bytes],
+                 user_agent_evidence: Iterable[UserAgentEvidence],
+                 mode: str = EXACT):
+        if mode not in PLAN_MODES:
+            raise ValueError(mode)
+        self.mode = mode
+        self.graph = EvidenceGraph(user_agent_evidence)
+        self.possible_instance_ips = set(possible_instance_ips)
+        self.nonexistent_hostnames = set()
+        self.forward_confirmed_ips = set()
+        self.conclusive_domains = set()
+        self.tls_invalid = set()
+        self.tls_domains = set()
+        self.api_domains = set()
+        self.done = DefaultDict(int)
+        self.skipped = DefaultDict(int)
+        self.lossy = DefaultDict(int)
+
+    def forward_dns_hostnames(self) -> List[str]:
+        hostnames = self.graph.hostnames()
+        self.done['forward_dns'] += len(hostnames)
+        return hostnames
+
+    def record_forward_dns(self, hostname: str, evidence: List[ForwardDNSEvidence],
+                           exists: bool) -> None:
+        if exists is False:
+            self.nonexistent_hostnames.add(hostname)
+        for e in evidence:
+            self.forward_confirmed_ips.add(e.ip)
+
+    def reverse_dns_ips(self) -> List[bytes]:
+        """
+        Call after forward DNS lookups have been recorded.
+        """
+        ips = sorted(self.possible_instance_ips)
+        if self.mode == CONCLUSIVE:
+            planned = [ip for ip in ips if ip not in self.forward_confirmed_ips]
+            self.skipped['reverse_dns'] += len(ips) - len(planned)
+            self.lossy['reverse_dns'] += len(ips) - len(planned)
+            ips = planned
+        self.done['reverse_dns'] += len(ips)
+        return ips
+
+    def tls_checks(self) -> List[Tuple[str, int]]:
+        """
+        Call after forward DNS lookups have been recorded.
+        """
+        checks = []
+        for hostname, port in self.graph.probes():
+            if self.mode != FULL and hostname in self.nonexistent_hostnames:
+                self.skipped['tls'] += 1
+                continue
+            checks.append((hostname, port))
+        self.done['tls'] += len(checks)
+        return checks
+
+    def record_tls(self, hostname: str, port: int, evidence: List[TLSCertCheckEvidence],
+                   valid: Optional[bool]) -> None:
+        """
+        :param valid: As in `fedimap.tls.TLSCheckResult`.
+        """
+        if valid is False:
+            self.tls_invalid.add((hostname, port))
+        self.record_probe(evidence)
+
+    def num_probes(self) -> int:
+        """
+        :return: Upper bound on the number of probes `probes` will return.
+        """
+        return len(self.graph.probes())
+
+    def probes(self) -> Iterator[Tuple[str, int]]:
+        """
+        Lazily, so results recorded for earlier probes can short-circuit later ones.
+        Call after TLS cert checks have been recorded.
+        """
+        for hostname, port in self.graph.probes():
+            if self.mode != FULL and hostname in self.nonexistent_hostnames:
+                self.skipped['probe'] += 1
+                continue
+            if self.mode != FULL and (hostname, port) in self.tls_invalid:
+                self.skipped['probe'] += 1
+                self.lossy['probe'] += 1
+                continue
+            if self.mode == CONCLUSIVE \
+                    and self.graph.hostname_domains[hostname] in self.conclusive_domains:
+                self.skipped['probe'] += 1
+                self.lossy['probe'] += 1
+                continue
+            self.done['probe'] += 1
+            yield hostname, port
+
+    def record_probe(self, evidence: List[InstanceEvidence]) -> None:
+        for e in evidence:
+            if isinstance(e, TLSCertCheckEvidence):
+                self.tls_domains.add(e.domain)
+            elif isinstance(e, InstanceAPIEvidence):
+                self.api_domains.add(e.domain)
+            if e.domain in self.tls_domains and e.domain in self.api_domains:
+                self.conclusive_domains.add(e.domain)
+
+    def report(self) -> None:
+        report_plan(self.mode, self.done, self.skipped, self.lossy)
+
+
+def report_plan(mode: str, done: Dict[str, int], skipped: Dict[str, int],
+                lossy: Dict[str, int]) -> None:
+    """
+    Log how much work each network stage did and skipped,
+    and how many of the skips may have changed the output.
+    """
+    for stage in ('forward_dns', 'reverse_dns', 'tls', 'probe'):
+        stage_done = done.get(stage, 0)
+        stage_skipped = skipped.get(stage, 0)
+        total = stage_done + stage_skipped
+        _logger.info(
+            "Plan (%(mode)s): %(stage)s: %(done)d done, %(skipped)d skipped "
+            "(%(percent).1f%% saved, %(lossy)d lossy).",
+            {
+                'mode': mode,
+                'stage': stage,
+                'done': stage_done,
+                'skipped': stage_skipped,
+                'lossy': lossy.get(stage, 0),
+                'percent': 100 * stage_skipped / total if total else 0.0,
+            }
+        )
@@ -0,0 +1,139 @@
+import unittest
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+from fedimap.evidence import ForwardDNSEvidence, InstanceAPIEvidence, TLSCertCheckEvidence, \
+    TimeWindowAcc, TrafficAcc, UserAgentEvidence
+from fedimap.planner import CONCLUSIVE, EXACT, FULL, EvidencePlanner
+from fedimap.user_agent import InstanceUserAgent
+
+_time = datetime(2018, 12, 28, tzinfo=timezone.utc)
+_instance_user_agent = InstanceUserAgent(pattern_name='test', server='mastodon')
+
+
+def _ua(ip: bytes, hostname: str, domain: str, port: int = 443) -> UserAgentEvidence:
+    return UserAgentEvidence(
+        ip=ip,
+        hostname=hostname,
+        domain=domain,
+        port=port,
+        instance_user_agent=_instance_user_agent,
+        time_window=TimeWindowAcc(),
+        traffic=TrafficAcc(),
+    )
+
+
+_ip_a = bytes([192, 0, 2, 1])
+_ip_b = bytes([192, 0, 2, 2])
+_ip_c = bytes([192, 0, 2, 3])
+
+_user_agent_evidence = [
+    _ua(_ip_a, 'www.example.org', 'example.org'),
+    _ua(_ip_a, 'example.org', 'example.org'),
+    _ua(_ip_b, 'example.org', 'example.org'),
+    _ua(_ip_c, 'gone.example.net', 'example.net'),
+]
+
+
+def _planner(mode: str, bad_tls: Tuple[str, ...] = (),
+             tls_timeout: Tuple[str, ...] = ()) -> EvidencePlanner:
+    """
+    Pretend forward DNS and TLS cert checks succeed except for `gone.example.net`,
+    which doesn't exist, hostnames in `bad_tls`, whose certs fail verification,
+    and hostnames in `tls_timeout`, whose handshakes time out.
+    """
+    planner = EvidencePlanner([_ip_a, _ip_b, _ip_c], _user_agent_evidence, mode=mode)
+    for hostname in planner.forward_dns_hostnames():
+        if hostname == 'gone.example.net':
+            planner.record_forward_dns(hostname, [], False)
+        else:
+            planner.record_forward_dns(hostname, [ForwardDNSEvidence(
+                ip=_ip_a, hostname=hostname, domain='example.org', time=_time,
+            )], True)
+    for hostname, port in planner.tls_checks():
+        if hostname == 'gone.example.net' or hostname in tls_timeout:
+            planner.record_tls(hostname, port, [], None)
+        elif hostname in bad_tls:
+            planner.record_tls(hostname, port, [], False)
+        else:
+            planner.record_tls(hostname, port, [TLSCertCheckEvidence(
+                hostname=hostname, domain=planner.graph.hostname_domains[hostname], port=port,
+                time=_time,
+            )], True)
+    return planner
+
+
+def _run_probes(planner: EvidencePlanner) -> List[Tuple[str, int]]:
+    """
+    Pretend every probe finds an instance that identifies itself with the probed hostname.
+    """
+    probed = []
+    for hostname, port in planner.probes():
+        probed.append((hostname, port))
+        domain = planner.graph.hostname_domains[hostname]
+        planner.record_probe([
+            InstanceAPIEvidence(hostname=hostname, domain=domain, port=port,
+                                instance_user_agent=_instance_user_agent, time=_time),
+        ])
+    return probed
+
+
+class TestEvidencePlanner(unittest.TestCase):
+    def test_full(self):
+        planner = _planner(FULL)
+        self.assertEqual(planner.reverse_dns_ips(), [_ip_a, _ip_b, _ip_c])
+        self.assertEqual(_run_probes(planner), [
+            ('gone.example.net', 443),
+            ('example.org', 443),
+            ('www.example.org', 443),
+        ])
+        self.assertEqual(planner.done['tls'], 3)
+        self.assertEqual(planner.skipped['probe'], 0)
+
+    def test_exact_skips_nonexistent_hostnames(self):
+        planner = _planner(EXACT)
+        self.assertEqual(planner.reverse_dns_ips(), [_ip_a, _ip_b, _ip_c])
+        self.assertEqual(_run_probes(planner), [
+            ('example.org', 443),
+            ('www.example.org', 443),
+        ])
+        self.assertEqual(planner.done['tls'], 2)
+        self.assertEqual(planner.skipped['tls'], 1)
+        self.assertEqual(planner.done['probe'], 2)
+        self.assertEqual(planner.skipped['probe'], 1)
+        self.assertEqual(planner.lossy['probe'], 0)
+
+    def test_exact_skips_failed_tls(self):
+        planner = _planner(EXACT, bad_tls=('www.example.org',))
+        self.assertEqual(_run_probes(planner), [('example.org', 443)])
+        self.assertEqual(planner.skipped['probe'], 2)
+        self.assertEqual(planner.lossy['probe'], 1)
+
+    def test_exact_probes_after_tls_timeout(self):
+        planner = _planner(EXACT, tls_timeout=('www.example.org',))
+        self.assertEqual(_run_probes(planner), [
+            ('example.org', 443),
+            ('www.example.org', 443),
+        ])
+        self.assertEqual(planner.lossy['probe'], 0)
+
+    def test_conclusive_stops_after_confirmation(self):
+        planner = _planner(CONCLUSIVE)
+        # Forward DNS already tied _ip_a to an instance hostname.
+        self.assertEqual(planner.reverse_dns_ips(), [_ip_b, _ip_c])
+        # example.org has the most IPs, so it goes first, and confirms the instance.
+        self.assertEqual(_run_probes(planner), [('example.org', 443)])
+        self.assertEqual(planner.skipped['reverse_dns'], 1)
+        self.assertEqual(planner.skipped['probe'], 2)
+
+    def test_conclusive_needs_instance_api(self):
+        planner = _planner(CONCLUSIVE)
+        probed = []
+        for hostname, port in planner.probes():
+            # The instance API doesn't answer.
+            probed.append((hostname, port))
+        self.assertEqual(probed, [('example.org', 443), ('www.example.org', 443)])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            EvidencePlanner([], [], mode='psychic')
@@ -0,0 +1,211 @@
+"""
+Progress reporting for long runs: throttled log lines, and the same counters in
+Prometheus text format for `fedimap.metrics`.
+
+Counters are plain attributes updated from the main thread and read from the metrics server
+thread without locking; a momentarily stale read is fine for monitoring. Stages can be added while
+they're being read, so readers iterate over a copy of them.
+"""
+
+__all__ = ['Progress', 'StageProgress']
+
+import logging
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+_logger = logging.getLogger(__name__)
+
+# Check the clock only this often while parsing, since it's called for every line.
+_lines_per_clock_check = 4096
+
+
+def _fmt_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return 'unknown'
+    return str(timedelta(seconds=int(seconds)))
+
+
+def _fmt_bytes(n: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if n < 1024:
+            return '{n:.1f} {unit}'.format(n=n, unit=unit)
+        n /= 1024
+    return '{n:.1f} TB'.format(n=n)
+
+
+class StageProgress:
+    """
+    Counters for one network stage, such as reverse DNS lookups.
+    """
+    name: str
+    total: int = 0
+    done: int = 0
+    started: float
+
+    def __init__(self, name: str, total: int = 0):
+        self.name = name
+        self.total = total
+        self.started = time.monotonic()
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.total - self.done)
+
+    def rate(self, now: float) -> float:
+        """
+        :return: Items completed per second.
+        """
+        elapsed = now - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def eta(self, now: float) -> Optional[float]:
+        rate = self.rate(now)
+        return self.queued / rate if rate > 0 else None
+
+
+class Progress:
+    """
+    Tracks log parsing and network stages, and logs a summary at most every `interval` seconds.
+    """
+    interval: float
+    started: float
+    last_report: float
+    parsing_finished: Optional[float] = None
+    total_bytes: int = 0
+    bytes_parsed: int = 0
+    lines_parsed: int = 0
+    stages: Dict[str, StageProgress]
+
+    def __init__(self, interval: float = 10.0, total_bytes: int = 0):
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.total_bytes = total_bytes
+        self.stages = {}
+        self._lines_until_clock_check = _lines_per_clock_check
+
+    def parsed_line(self, num_bytes: int) -> None:
+        self.lines_parsed += 1
+        self.bytes_parsed += num_bytes
+        self._lines_until_clock_check -= 1
+        if self._lines_until_clock_check <= 0:
+            self._lines_until_clock_check = _lines_per_clock_check
+            self.maybe_report()
+
+    def finish_parsing(self) -> None:
+        """
+        Stop the clock for log parsing rates.
+        """
+        self.parsing_finished = time.monotonic()
+
+    def start_stage(self, name: str, total: int = 0) -> StageProgress:
+        stage = StageProgress(name, total)
+        self.stages[name] = stage
+        return stage
+
+    def advance(self, name: str, n: int = 1) -> None:
+        self.stages[name].done += n
+        self.maybe_report()
+
+    def maybe_report(self) -> None:
+        if self.interval <= 0:
+            return
+        now = time.monotonic()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(now)
+
+    def report(self, now: Optional[float] = None) -> None:
+        """
+        Log a summary now, unless reporting is turned off with an interval of 0.
+        """
+        if self.interval <= 0:
+            return
+        if now is None:
+            now = time.monotonic()
+        for line in self.summary(now):
+            _logger.info('%s', line)
+
+    def summary(self, now: float) -> List[str]:
+        elapsed = (self.parsing_finished or now) - self.started
+        lines = []
+
+        if self.lines_parsed:
+            byte_rate = self.bytes_parsed / elapsed if elapsed > 0 else 0.0
+            line_rate = self.lines_parsed / elapsed if elapsed > 0 else 0.0
+            if self.total_bytes:
+                percent = 100 * self.bytes_parsed / self.total_bytes
+                eta = (self.total_bytes - self.bytes_parsed) / byte_rate if byte_rate > 0 else None
+                lines.append(
+                    'logs: {parsed} of {total} ({percent:.1f}%), {lines} lines, '
+                    '{byte_rate}/s, {line_rate:.0f} lines/s, ETA {eta}'.format(
+                        parsed=_fmt_bytes(self.bytes_parsed),
+                        total=_fmt_bytes(self.total_bytes),
+                        percent=percent,
+                        lines=self.lines_parsed,
+                        byte_rate=_fmt_bytes(byte_rate),
+                        line_rate=line_rate,
+                        eta=_fmt_eta(eta),
+                    )
+                )
+            else:
+                lines.append(
+                    'logs: {parsed}, {lines} lines, {byte_rate}/s, {line_rate:.0f} lines/s'.format(
+                        parsed=_fmt_bytes(self.bytes_parsed),
+                        lines=self.lines_parsed,
+                        byte_rate=_fmt_bytes(byte_rate),
+                        line_rate=line_rate,
+                    )
+                )
+
+        for stage in list(self.stages.values()):
+            lines.append(
+                '{name}: {done}/{total} done, {queued} queued, {rate:.1f}/s, ETA {eta}'.format(
+                    name=stage.name,
+                    done=stage.done,
+                    total=stage.total,
+                    queued=stage.queued,
+                    rate=stage.rate(now),
+                    eta=_fmt_eta(stage.eta(now)),
+                )
+            )
+
+        return lines
+
+    def render_metrics(self) -> str:
+        """
+        :return: Counters in Prometheus text exposition format.
+        """
+        now = time.monotonic()
+        out = []
+
+        def metric(name: str, kind: str, help_text: str, samples: Dict[str, float]) -> None:
+            out.append('# HELP {name} {help_text}'.format(name=name, help_text=help_text))
+            out.append('# TYPE {name} {kind}'.format(name=name, kind=kind))
+            for labels, value in samples.items():
+                out.append('{name}{labels} {value}'.format(name=name, labels=labels, value=value))
+
+        metric('fedimap_elapsed_seconds', 'gauge', 'Seconds since the run started.',
+               {'': round(now - self.started, 3)})
+        metric('fedimap_log_bytes', 'gauge', 'Total size of the access logs being parsed.',
+               {'': self.total_bytes})
+        metric('fedimap_log_bytes_parsed_total', 'counter', 'Bytes of access logs parsed.',
+               {'': self.bytes_parsed})
+        metric('fedimap_log_lines_parsed_total', 'counter', 'Lines of access logs parsed.',
+               {'': self.lines_parsed})
+
+        def by_stage(attr: str) -> Dict[str, float]:
+            return {
+                '{{stage="{name}"}}'.format(name=stage.name): getattr(stage, attr)
+                for stage in list(self.stages.values())
+            }
+
+        metric('fedimap_stage_items', 'gauge', 'Items of work in each network stage.',
+               by_stage('total'))
+        metric('fedimap_stage_items_done_total', 'counter',
+               'Items of work completed in each network stage.', by_stage('done'))
+        metric('fedimap_stage_items_queued', 'gauge',
+               'Items of work waiting in each network stage.', by_stage('queued'))
+
+        return '\n'.join(out) + '\n'
@@ -0,0 +1,59 @@
+import unittest
+from urllib.request import urlopen
+
+from fedimap.metrics import MetricsServer
+from fedimap.progress import Progress, StageProgress
+
+
+class TestProgress(unittest.TestCase):
+    def setUp(self):
+        self.progress = Progress(interval=0, total_bytes=1000)
+        for _ in range(10):
+            self.progress.parsed_line(50)
+        self.progress.finish_parsing()
+        self.progress.start_stage('reverse_dns', 4)
+        self.progress.advance('reverse_dns')
+
+    def test_summary(self):
+        summary = self.progress.summary(self.progress.started + 1.0)
+        self.assertIn('500.0 B of 1000.0 B (50.0%), 10 lines', summary[0])
+        self.assertIn('reverse_dns: 1/4 done, 3 queued', summary[1])
+
+    def test_render_metrics(self):
+        metrics = self.progress.render_metrics()
+        self.assertIn('# TYPE fedimap_log_bytes_parsed_total counter\n', metrics)
+        self.assertIn('fedimap_log_bytes_parsed_total 500\n', metrics)
+        self.assertIn('fedimap_log_lines_parsed_total 10\n', metrics)
+        self.assertIn('fedimap_stage_items_queued{stage="reverse_dns"} 3\n', metrics)
+
+    def test_report_off(self):
+        with self.assertRaises(AssertionError):
+            with self.assertLogs('fedimap.progress'):
+                self.progress.report()
+
+    def test_stage_added_while_reading(self):
+        progress = self.progress
+
+        class StartsStageWhenRead(StageProgress):
+            @property
+            def queued(self) -> int:
+                # As if the main thread started a stage while the metrics thread reads this one.
+                progress.start_stage('probe_{n}'.format(n=len(progress.stages)))
+                return 0
+
+        progress.stages['forward_dns'] = StartsStageWhenRead('forward_dns')
+        self.assertIn('fedimap_stage_items_queued{stage="forward_dns"} 0\n',
+                      progress.render_metrics())
+        self.assertIn('forward_dns: 0/0 done, 0 queued', '\n'.join(progress.summary(0)))
+
+    def test_metrics_server(self):
+        server = MetricsServer(self.progress, 0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:{port}/metrics'.format(port=server.port)
+            with urlopen(url) as resp:
+                self.assertEqual(resp.status, 200)
+                body = resp.read().decode('utf-8')
+        finally:
+            server.stop()
+        self.assertIn('fedimap_stage_items_done_total{stage="reverse_dns"} 1\n', body)
@@ -0,0 +1,101 @@
+"""
+HyperLogLog sketch for approximate distinct counts in bounded memory.
+
+With the default precision, each sketch is 256 bytes and counts are within about 6.5%
+(one standard error). Hashes come from BLAKE2b rather than `hash`, which is salted per process,
+so the same logs always give the same counts.
+
+See https://algo.inria.fr/flajolet/Publications/FlFuGaMe07.pdf
+"""
+
+__all__ = ['DEFAULT_PRECISION', 'HyperLogLog', 'hll_hash', 'hll_register']
+
+import hashlib
+import math
+from typing import Optional, Tuple, Union
+
+# Number of hash bits used to pick a register: 2 ** 8 registers.
+DEFAULT_PRECISION = 8
+
+
+def hll_hash(item: str) -> int:
+    """
+    :return: Stable 64-bit hash of a string.
+    """
+    # Paths decoded from JSON can contain lone surrogates.
+    return int.from_bytes(
+        hashlib.blake2b(item.encode('utf-8', 'surrogatepass'), digest_size=8).digest(),
+        'big'
+    )
+
+
+def hll_register(h: int, precision: int = DEFAULT_PRECISION) -> Tuple[int, int]:
+    """
+    :return: Register index and rank (position of the first set bit, from 1)
+        for a 64-bit hash.
+    """
+    width = 64 - precision
+    rest = h & ((1 << width) - 1)
+    return h >> width, width - rest.bit_length() + 1
+
+
+def _alpha(m: int) -> float:
+    if m == 16:
+        return 0.673
+    if m == 32:
+        return 0.697
+    if m == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / m)
+
+
+class HyperLogLog:
+    """
+    Accumulator for an approximate count of distinct strings.
+    """
+    precision: int
+    registers: bytearray
+
+    def __init__(self, precision: int = DEFAULT_PRECISION, registers: Optional[bytes] = None):
+        if not 4 <= precision <= 16:
+            raise ValueError(precision)
+        self.precision = precision
+        if registers is None:
+            self.registers = bytearray(1 << precision)
+        elif len(registers) != 1 << precision:
+            raise ValueError(registers)
+        else:
+            self.registers = bytearray(registers)
+
+    def __repr__(self) -> str:
+        return '{module}.{qualname}(precision={precision!r}, count={count!r})'.format(
+            module=self.__class__.__module__,
+            qualname=self.__class__.__qualname__,
+            precision=self.precision,
+            count=self.count(),
+        )
+
+    def copy(self) -> 'HyperLogLog':
+        return HyperLogLog(self.precision, self.registers)
+
+    def add_register(self, index: int, rank: int) -> None:
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def add(self, x: Union[str, 'HyperLogLog']) -> None:
+        if isinstance(x, HyperLogLog):
+            if x.precision != self.precision:
+                raise ValueError(x)
+            self.registers = bytearray(map(max, self.registers, x.registers))
+        else:
+            self.add_register(*hll_register(hll_hash(x), self.precision))
+
+    def count(self) -> int:
+        m = len(self.registers)
+        estimate = _alpha(m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction: linear counting is more accurate here.
+            estimate = m * math.log(m / zeros)
+        # 64-bit hashes don't need the large range correction.
+        return round(estimate)
@@ -0,0 +1,47 @@
+import unittest
+
+from fedimap.sketch import HyperLogLog, hll_register
+
+
+class TestHyperLogLog(unittest.TestCase):
+    def test_empty(self):
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_duplicates(self):
+        once = HyperLogLog()
+        thrice = HyperLogLog()
+        for i in range(10):
+            once.add('/users/{i}'.format(i=i))
+        for _ in range(3):
+            for i in range(10):
+                thrice.add('/users/{i}'.format(i=i))
+        self.assertEqual(thrice.registers, once.registers)
+        self.assertAlmostEqual(thrice.count(), 10, delta=1)
+
+    def test_accuracy(self):
+        hll = HyperLogLog()
+        for i in range(20000):
+            hll.add('/objects/{i}'.format(i=i))
+        # Four standard errors at the default precision.
+        self.assertAlmostEqual(hll.count(), 20000, delta=20000 * 0.26)
+
+    def test_merge(self):
+        a = HyperLogLog()
+        b = HyperLogLog()
+        union = HyperLogLog()
+        for i in range(1000):
+            a.add(str(i))
+            union.add(str(i))
+        for i in range(500, 2000):
+            b.add(str(i))
+            union.add(str(i))
+        a.add(b)
+        self.assertEqual(a.registers, union.registers)
+
+    def test_register(self):
+        self.assertEqual(hll_register(0), (0, 57))
+        self.assertEqual(hll_register((1 << 64) - 1), (255, 1))
+        self.assertEqual(hll_register(1 << 55), (0, 1))
+
+    def test_lone_surrogate(self):
+        HyperLogLog().add('/\ud800')
@@ -0,0 +1,175 @@
+"""
+Bounded-memory aggregation that spills to temporary files.
+
+Scanner floods with spoofed instance user agents can produce millions of distinct IPs.
+Once the number of (IP, instance user agent) pairs held in memory reaches a limit, they're written
+out as a sorted run of (IP, user agent, first seen, last seen, active days, traffic) lines
+and memory is cleared.
+At the end, all runs plus whatever is still in memory are k-way merged, combining entries
+for the same pair. The merged stream is in the same order as `IncomingIPsAcc.items`,
+so everything downstream sees exactly what it would have with unbounded memory.
+"""
+
+__all__ = ['BYTES_PER_ENTRY', 'SpillingIncomingIPsAcc']
+
+import heapq
+import json
+from array import array
+import tempfile
+from datetime import datetime
+from typing import IO, Iterator, List, Optional, Tuple, Union
+
+from fedimap.access_log import LogRecord
+from fedimap.evidence import ActiveDaysAcc, TimeWindowAcc, TrafficAcc
+from fedimap.incoming import IncomingIPsAcc, user_agent_sort_key
+from fedimap.sketch import HyperLogLog
+from fedimap.user_agent import InstanceUserAgent
+
+# Rough upper bound on the memory used per (IP, instance user agent) pair held in memory:
+# nested dict slots, the per-IP inner dict, the packed IP, the accumulator, its datetimes,
+# its active days, its entry number, and its traffic counters.
+# Instance user agents are shared between entries and aren't counted.
+# Distinct path sketches are counted separately.
+BYTES_PER_ENTRY = 1024
+
+# Maximum number of runs merged at once. More than this and runs are merged down into one first,
+# to stay well below open file limits.
+_max_merge_fan_in = 64
+
+_Entry = Tuple[Tuple[bytes, str], bytes, InstanceUserAgent, TimeWindowAcc, TrafficAcc]
+
+
+def _write_entry(f: IO[str], ip: bytes, instance_user_agent: InstanceUserAgent,
+                 time_window: TimeWindowAcc, traffic: TrafficAcc) -> None:
+    # Tabs and newlines can't occur in hex or in JSON's string escapes.
+    f.write('\t'.join((
+        ip.hex(),
+        user_agent_sort_key(instance_user_agent),
+        time_window.min.isoformat(),
+        time_window.max.isoformat(),
+        str(time_window.days.base),
+        '{bits:x}'.format(bits=time_window.days.bits),
+        ','.join(str(count) for count in traffic.counts),
+        traffic.paths.registers.hex() if traffic.paths is not None else '',
+    )))
+    f.write('\n')
+
+
+def _read_run(f: IO[str]) -> Iterator[_Entry]:
+    f.seek(0)
+    for line in f:
+        ip_hex, ua_json, min_iso, max_iso, days_base, days_bits, traffic_counts, traffic_paths = \
+            line.rstrip('\n').split('\t')
+        ip = bytes.fromhex(ip_hex)
+        time_window = TimeWindowAcc(min=datetime.fromisoformat(min_iso),
+                                    max=datetime.fromisoformat(max_iso))
+        time_window.days = ActiveDaysAcc(base=int(days_base), bits=int(days_bits, 16))
+        traffic = TrafficAcc(
+            counts=array('q', (int(count) for count in traffic_counts.split(','))),
+            paths=HyperLogLog(registers=bytes.fromhex(traffic_paths)) if traffic_paths else None,
+        )
+        yield (ip, ua_json), ip, InstanceUserAgent(*json.loads(ua_json)), time_window, traffic
+
+
+def _in_memory_run(
+        items: Iterator[Tuple[bytes, InstanceUserAgent, TimeWindowAcc, TrafficAcc]]
+) -> Iterator[_Entry]:
+    for ip, instance_user_agent, time_window, traffic in items:
+        yield (ip, user_agent_sort_key(instance_user_agent)), ip, instance_user_agent, \
+            time_window, traffic
+
+
+def _merge(runs: List[Iterator[_Entry]]) -> Iterator[_Entry]:
+    """
+    Merge sorted runs, combining time windows and traffic for the same (IP, user agent) pair.
+    Runs are given in the order their records were read, and `heapq.merge` breaks ties in favor
+    of earlier runs, so windows are combined in the same order as in memory.
+    """
+    current: Optional[_Entry] = None
+    for entry in heapq.merge(*runs, key=lambda e: e[0]):
+        if current is not None and current[0] == entry[0]:
+            current[3].add(entry[3])
+            current[4].add(entry[4])
+        else:
+            if current is not None:
+                yield current
+            current = entry
+    if current is not None:
+        yield current
+
+
+class SpillingIncomingIPsAcc(IncomingIPsAcc):
+    """
+    Accumulator for time windows per IP and instance user agent
+    that holds at most `max_entries` pairs in memory.
+    """
+    max_entries: int
+    tmp_dir: Optional[str]
+    runs: List[IO[str]]
+    # Total number of entries written to runs, for logging.
+    num_spilled: int = 0
+
+    def __init__(self, max_entries: int, tmp_dir: Optional[str] = None,
+                 distinct_paths: bool = False):
+        super().__init__(distinct_paths=distinct_paths)
+        if max_entries < 1:
+            raise ValueError()
+        self.max_entries = max_entries
+        self.tmp_dir = tmp_dir
+        self.runs = []
+
+    @classmethod
+    def for_max_memory(cls, max_memory: int,
+                       tmp_dir: Optional[str] = None,
+                       distinct_paths: bool = False) -> 'SpillingIncomingIPsAcc':
+        """
+        :param max_memory: Approximate memory budget for aggregation, in bytes.
+        """
+        bytes_per_entry = BYTES_PER_ENTRY
+        if distinct_paths:
+            # Registers plus object overhead.
+            bytes_per_entry += len(HyperLogLog().registers) + 128
+        return cls(max(1, max_memory // bytes_per_entry), tmp_dir=tmp_dir,
+                   distinct_paths=distinct_paths)
+
+    def add(self,
+            ip: bytes,
+            instance_user_agent: InstanceUserAgent,
+            x: Union[datetime, TimeWindowAcc],
+            traffic: Union[LogRecord, TrafficAcc, None] = None) -> None:
+        super().add(ip, instance_user_agent, x, traffic)
+        if self.num_entries >= self.max_entries:
+            self._spill()
+
+    def _new_run(self) -> IO[str]:
+        return tempfile.TemporaryFile(mode='w+', encoding='utf-8', prefix='fedimap-',
+                                      suffix='.run', dir=self.tmp_dir)
+
+    def _spill(self) -> None:
+        run = self._new_run()
+        for ip, instance_user_agent, time_window, traffic in super().items():
+            _write_entry(run, ip, instance_user_agent, time_window, traffic)
+        run.flush()
+        self.runs.append(run)
+        self.num_spilled += self.num_entries
+
+        self.clear()
+
+        if len(self.runs) >= _max_merge_fan_in:
+            merged = self._new_run()
+            for _, ip, instance_user_agent, time_window, traffic in _merge(
+                    [_read_run(run) for run in self.runs]):
+                _write_entry(merged, ip, instance_user_agent, time_window, traffic)
+            merged.flush()
+            self.close()
+            self.runs = [merged]
+
+    def items(self) -> Iterator[Tuple[bytes, InstanceUserAgent, TimeWindowAcc, TrafficAcc]]:
+        runs = [_read_run(run) for run in self.runs] + [_in_memory_run(super().items())]
+        for _, ip, instance_user_agent, time_window, traffic in _merge(runs):
+            yield ip, instance_user_agent, time_window, traffic
+
+    def close(self) -> None:
+        for run in self.runs:
+            run.close()
+        self.runs = []
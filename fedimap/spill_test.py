@@ -0,0 +1,67 @@
+import socket
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from fedimap.access_log import LogRecord
+from fedimap.incoming import IncomingIPsAcc
+from fedimap.spill import SpillingIncomingIPsAcc
+from fedimap.user_agent import classify_user_agent
+
+_mastodon = classify_user_agent('http.rb/3.3.0 (Mastodon/2.6.5; +https://example.org/)')
+_mastodon_probably = classify_user_agent('http.rb/3.3.0')
+_pleroma_probably = classify_user_agent('hackney/1.13.0')
+
+_start = datetime(2018, 12, 27, 18, 20, 28, tzinfo=timezone.utc)
+
+
+def _records():
+    """
+    A flood of spoofed user agents from many IPs, interleaved with a real instance.
+    """
+    for i in range(500):
+        ip = socket.inet_pton(socket.AF_INET, '10.0.{hi}.{lo}'.format(hi=i // 256, lo=i % 256))
+        ua = _mastodon_probably if i % 2 else _pleroma_probably
+        yield ip, ua, _start + timedelta(minutes=i), 200, '/'
+        yield socket.inet_pton(socket.AF_INET, '12.34.56.78'), _mastodon, \
+            _start - timedelta(hours=i % 7), 202, '/inbox'
+        yield socket.inet_pton(socket.AF_INET6, '::{i:x}'.format(i=i % 13)), ua, \
+            (_start + timedelta(days=i % 5)).astimezone(timezone(timedelta(hours=8))), \
+            404 if i % 3 else 500, '/users/{i}'.format(i=i)
+
+
+def _frozen(acc):
+    return [
+        (ip, ua, time_window.min, time_window.min.utcoffset(),
+         time_window.max, time_window.max.utcoffset(), time_window.days.freeze(),
+         traffic.freeze())
+        for ip, ua, time_window, traffic in acc.items()
+    ]
+
+
+class TestSpill(unittest.TestCase):
+    def assert_same_as_in_memory(self, max_entries):
+        expected = IncomingIPsAcc(distinct_paths=True)
+        actual = SpillingIncomingIPsAcc(max_entries, distinct_paths=True)
+        for ip, ua, timestamp, status, path in _records():
+            log_record = LogRecord(ip=ip, timestamp=timestamp, method='GET', path=path,
+                                   protocol='HTTP/1.1', status=status, size=len(path))
+            expected.add(ip, ua, timestamp, log_record)
+            actual.add(ip, ua, timestamp, log_record)
+        try:
+            self.assertLessEqual(actual.num_entries, max_entries)
+            self.assertEqual(_frozen(actual), _frozen(expected))
+        finally:
+            actual.close()
+
+    def test_no_spill(self):
+        self.assert_same_as_in_memory(max_entries=10000)
+
+    def test_spill(self):
+        self.assert_same_as_in_memory(max_entries=50)
+
+    def test_spill_with_intermediate_merges(self):
+        self.assert_same_as_in_memory(max_entries=3)
+
+    def test_for_max_memory(self):
+        acc = SpillingIncomingIPsAcc.for_max_memory(1 << 20)
+        self.assertEqual(acc.max_entries, 1024)
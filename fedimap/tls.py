@@ -0,0 +1,129 @@
+"""
+TLS certificate checks that only do a handshake: connect, verify the cert chain and hostname,
+read the expiry and subject alternative names, and close. No HTTP, so a slow or broken instance API
+doesn't hide a valid cert or hold up the check.
+
+Certs are verified against the same CA bundle `requests` uses: `REQUESTS_CA_BUNDLE` or
+`CURL_CA_BUNDLE` if set, otherwise `certifi` when it's installed. So a cert that fails verification
+here would almost always fail for the instance API probes too. Handshakes that time out or fail for
+other reasons say nothing about the cert, and the API probes may still get through, such as with
+more time or through a proxy.
+"""
+
+__all__ = ['DEFAULT_TIMEOUT', 'TLSCertInfo', 'TLSCheckResult', 'default_context',
+           'check_tls_cert', 'check_tls_certs']
+
+import functools
+import logging
+import os
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+if TYPE_CHECKING:
+    import ssl
+
+# Seconds to wait for the connection, and then for the handshake.
+DEFAULT_TIMEOUT = 3.0
+
+_logger = logging.getLogger(__name__)
+
+
+class TLSCertInfo(NamedTuple):
+    # When the handshake started.
+    time: datetime
+    not_after: datetime
+    # DNS names from the cert's subject alternative name extension.
+    subject_alt_names: List[str]
+
+
+class TLSCheckResult(NamedTuple):
+    # Info from the cert if it's valid for the hostname.
+    info: Optional[TLSCertInfo]
+    # `True` if the cert was verified, `False` if it failed verification,
+    # `None` if the handshake didn't get far enough to tell, such as on timeouts.
+    valid: Optional[bool]
+
+
+@functools.lru_cache(maxsize=None)
+def default_context() -> 'ssl.SSLContext':
+    """
+    Shared between checks, since loading the CA bundle takes a while.
+    Contexts are safe to use from several threads.
+    """
+    # Deferred: ssl is slow to import and only needed for TLS checks.
+    import ssl
+    cafile = os.environ.get('REQUESTS_CA_BUNDLE') or os.environ.get('CURL_CA_BUNDLE')
+    if cafile is not None and os.path.isdir(cafile):
+        return ssl.create_default_context(capath=cafile)
+    if cafile is None:
+        try:
+            import certifi
+            cafile = certifi.where()
+        except ImportError:
+            pass
+    return ssl.create_default_context(cafile=cafile)
+
+
+def check_tls_cert(hostname: str,
+                   port: int,
+                   timeout: float = DEFAULT_TIMEOUT,
+                   context: Optional['ssl.SSLContext'] = None) -> TLSCheckResult:
+    """
+    Check that a hostname and port serve a valid TLS cert for that hostname.
+    """
+    import ssl
+
+    if context is None:
+        context = default_context()
+    time = datetime.now(timezone.utc)
+    try:
+        with socket.create_connection((hostname, port), timeout=timeout) as sock:
+            with context.wrap_socket(sock, server_hostname=hostname) as tls_sock:
+                cert = tls_sock.getpeercert()
+    except ssl.SSLCertVerificationError:
+        _logger.warning(
+            "Couldn't verify TLS cert for %(hostname)s:%(port)d!",
+            {'hostname': hostname, 'port': port},
+            exc_info=True
+        )
+        return TLSCheckResult(info=None, valid=False)
+    except OSError:
+        # Includes other `ssl.SSLError`s and timeouts.
+        _logger.warning(
+            "Exception on TLS handshake with %(hostname)s:%(port)d!",
+            {'hostname': hostname, 'port': port},
+            exc_info=True
+        )
+        return TLSCheckResult(info=None, valid=None)
+
+    return TLSCheckResult(
+        info=TLSCertInfo(
+            time=time,
+            not_after=datetime.fromtimestamp(ssl.cert_time_to_seconds(cert['notAfter']),
+                                             timezone.utc),
+            subject_alt_names=sorted(
+                value for kind, value in cert.get('subjectAltName', ()) if kind == 'DNS'
+            ),
+        ),
+        valid=True,
+    )
+
+
+def check_tls_certs(hostnames_and_ports: Iterable[Tuple[str, int]],
+                    workers: int,
+                    timeout: float = DEFAULT_TIMEOUT,
+                    context: Optional['ssl.SSLContext'] = None
+                    ) -> Iterator[Tuple[str, int, TLSCheckResult]]:
+    """
+    Check certs on a thread pool.
+
+    :return: (hostname, port, result) for every hostname and port, in the order given.
+    """
+    def check(hostname_and_port: Tuple[str, int]) -> Tuple[str, int, TLSCheckResult]:
+        hostname, port = hostname_and_port
+        return hostname, port, check_tls_cert(hostname, port, timeout=timeout, context=context)
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fedimap-tls') as executor:
+        yield from executor.map(check, hostnames_and_ports)
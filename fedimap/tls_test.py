@@ -0,0 +1,124 @@
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from fedimap.tls import check_tls_cert, check_tls_certs
+
+
+def _openssl(*args: str, cwd: str) -> None:
+    subprocess.run(['openssl'] + list(args), cwd=cwd, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _make_certs(d: str) -> None:
+    """
+    Write a test CA, and a cert signed by it for `localhost` and `example.test`.
+    """
+    _openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+             '-keyout', 'ca.key', '-out', 'ca.crt', '-subj', '/CN=fedimap test CA',
+             '-addext', 'basicConstraints=critical,CA:TRUE',
+             '-addext', 'keyUsage=critical,keyCertSign,cRLSign', cwd=d)
+    _openssl('req', '-newkey', 'rsa:2048', '-nodes',
+             '-keyout', 'server.key', '-out', 'server.csr', '-subj', '/CN=localhost', cwd=d)
+    with open(os.path.join(d, 'server.ext'), 'w') as f:
+        f.write('basicConstraints=critical,CA:FALSE\n'
+                'keyUsage=critical,digitalSignature,keyEncipherment\n'
+                'extendedKeyUsage=serverAuth\n'
+                'subjectAltName=DNS:localhost,DNS:example.test\n'
+                'authorityKeyIdentifier=keyid\n'
+                'subjectKeyIdentifier=hash\n')
+    _openssl('x509', '-req', '-in', 'server.csr', '-CA', 'ca.crt', '-CAkey', 'ca.key',
+             '-CAcreateserial', '-days', '2', '-extfile', 'server.ext', '-out', 'server.crt',
+             cwd=d)
+
+
+class _TLSServer:
+    """
+    Accepts connections on localhost and completes TLS handshakes, without speaking HTTP.
+    """
+
+    def __init__(self, certfile: str, keyfile: str):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(certfile, keyfile)
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self) -> None:
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            try:
+                with self.context.wrap_socket(conn, server_side=True):
+                    pass
+            except OSError:
+                # Clients that reject the cert hang up mid-handshake.
+                pass
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+@unittest.skipIf(shutil.which('openssl') is None, 'needs the openssl command to make test certs')
+class TestTLS(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        _make_certs(cls.dir)
+        cls.server = _TLSServer(os.path.join(cls.dir, 'server.crt'),
+                                os.path.join(cls.dir, 'server.key'))
+        cls.context = ssl.create_default_context(cafile=os.path.join(cls.dir, 'ca.crt'))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+        shutil.rmtree(cls.dir)
+
+    def test_valid(self):
+        result = check_tls_cert('localhost', self.server.port, context=self.context)
+        self.assertTrue(result.valid)
+        info = result.info
+        self.assertEqual(info.subject_alt_names, ['example.test', 'localhost'])
+        now = datetime.now(timezone.utc)
+        self.assertLess(now, info.not_after)
+        self.assertLess(info.not_after, now + timedelta(days=3))
+
+    def test_untrusted_ca(self):
+        with self.assertLogs('fedimap.tls', 'WARNING'):
+            result = check_tls_cert('localhost', self.server.port,
+                                    context=ssl.create_default_context())
+        self.assertEqual(result, (None, False))
+
+    def test_wrong_hostname(self):
+        # The cert has no IP address names.
+        with self.assertLogs('fedimap.tls', 'WARNING'):
+            result = check_tls_cert('127.0.0.1', self.server.port, context=self.context)
+        self.assertEqual(result, (None, False))
+
+    def test_timeout(self):
+        # Connections are queued by the kernel but never accepted, so the handshake never starts.
+        # That says nothing about the cert.
+        with socket.create_server(('127.0.0.1', 0)) as silent:
+            with self.assertLogs('fedimap.tls', 'WARNING'):
+                result = check_tls_cert('localhost', silent.getsockname()[1], timeout=0.2,
+                                        context=self.context)
+        self.assertEqual(result, (None, None))
+
+    def test_concurrent(self):
+        with self.assertLogs('fedimap.tls', 'WARNING'):
+            results = list(check_tls_certs(
+                [('localhost', self.server.port), ('127.0.0.1', self.server.port)] * 4,
+                workers=4,
+                context=self.context,
+            ))
+        self.assertEqual([(hostname, result.valid) for hostname, _, result in results],
+                         [('localhost', True), ('127.0.0.1', False)] * 4)